@@ -0,0 +1,40 @@
+"""
+Draw time and peak memory of services.draw.draw_winners against the number of participants.
+
+    python -m benchmarks.draw_benchmark
+"""
+import asyncio
+import time
+import tracemalloc
+
+from services.draw import draw_winners
+
+PAGE_SIZE = 1000
+NUM_WINNERS = 10
+
+
+async def participants(count: int):
+    # Emulates paginated reads: only one page is materialized at a time
+    for start in range(0, count, PAGE_SIZE):
+        page = {str(user_id): f"user{user_id}" for user_id in range(start, min(start + PAGE_SIZE, count))}
+        for item in page.items():
+            yield item
+
+
+async def main() -> None:
+    print(f"{'participants':>12} {'draw, s':>10} {'peak memory, KiB':>18}")
+    for count in (1_000, 10_000, 100_000, 1_000_000):
+        started = time.perf_counter()
+        winners, _ = await draw_winners(participants(count), NUM_WINNERS)
+        elapsed = time.perf_counter() - started
+        # Separate run, tracing allocations slows the draw down several times
+        tracemalloc.start()
+        await draw_winners(participants(count), NUM_WINNERS)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert len(set(winners)) == NUM_WINNERS
+        print(f"{count:>12} {elapsed:>10.3f} {peak / 1024:>18.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,213 @@
+"""
+Fake Bot API and storage for offline simulations: the real handlers run unchanged
+on top of them, Telegram and Firebase round-trips are emulated with sleeps.
+"""
+import asyncio
+import json
+import random
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
+from telegram.request import BaseRequest, RequestData
+
+from services.firebase import FirebaseClient
+from services.sqlite_storage import _as_arrays
+from services.storage import Storage
+
+BOT_ID = 1
+BOT_USERNAME = "fake_bot"
+
+
+class FakeBotAPI(BaseRequest):
+    """
+    Answers Bot API requests locally after latency seconds and records them.
+    A retry_after_rate share of requests fails with 429 Too Many Requests.
+    Everybody is a member of every chat.
+    """
+
+    def __init__(self, latency: float = 0.03, retry_after_rate: float = 0.0, retry_after: int = 1,
+                 seed: int = 0) -> None:
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._message_id = 0
+        self.calls: Counter[str] = Counter()
+        self.flood_errors = 0
+        # (time, endpoint, parameters) of every successful request
+        self.log: list[tuple[float, str, dict]] = []
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    def _result(self, endpoint: str, params: dict) -> object:
+        if endpoint == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "bot", "username": BOT_USERNAME}
+        if endpoint == "getChatMember":
+            user = {"id": int(params["user_id"]), "is_bot": False, "first_name": "user"}
+            return {"status": "member", "user": user}
+        if endpoint == "getUpdates":
+            return []
+        if endpoint.startswith(("send", "edit")):
+            self._message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            chat = {"id": chat_id, "type": "private" if chat_id > 0 else "channel"}
+            return {"message_id": params.get("message_id", self._message_id), "date": int(time.time()),
+                    "chat": chat, "text": params.get("text", "")}
+        return True
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        await asyncio.sleep(self.latency)
+        if endpoint != "getMe" and self._random.random() < self.retry_after_rate:
+            self.flood_errors += 1
+            return 429, json.dumps({
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }).encode()
+        self.calls[endpoint] += 1
+        self.log.append((time.monotonic(), endpoint, params))
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+
+def _normalized(value: object) -> object:
+    # Arrays are stored as objects keyed by index, empty objects and nulls are not stored
+    if isinstance(value, (list, tuple)):
+        value = {str(index): item for index, item in enumerate(value)}
+    if isinstance(value, dict):
+        value = {str(key): _normalized(item) for key, item in value.items()}
+        return {key: item for key, item in value.items() if item is not None} or None
+    return value
+
+
+class FakeFirebase(Storage):
+    """
+    In-memory JSON tree implementing only the Storage primitives, so the same Storage code
+    paths run as with FirebaseClient. Like Firebase, it doesn't keep empty nodes, returns
+    arrays for objects with sequential keys, orders key queries by FirebaseClient._key_order
+    and rejects multi-path updates of a path together with its descendant.
+    Every call answers after latency seconds, like a Firebase round-trip. Transactions
+    are applied at once after it, the conflicts and retries of the SDK are not emulated.
+    """
+
+    _key_order = staticmethod(FirebaseClient._key_order)
+
+    def __init__(self, latency: float = 0.02, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.tree: dict = {}
+        # Ordered child keys of the paths queried since the last write
+        self._ordered: dict[str, list[str]] = {}
+
+    @staticmethod
+    def _parts(path: str) -> list[str]:
+        return [part for part in path.split("/") if part]
+
+    def _node(self, path: str) -> object:
+        node = self.tree
+        for part in self._parts(path):
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def _set(self, path: str, value: object) -> None:
+        self._ordered.clear()
+        parts = self._parts(path)
+        value = _normalized(value)
+        if not parts:
+            self.tree = value if isinstance(value, dict) else {}
+            return
+        trail = [self.tree]
+        for part in parts[:-1]:
+            child = trail[-1].get(part)
+            if not isinstance(child, dict):
+                child = trail[-1][part] = {}
+            trail.append(child)
+        if value is None:
+            trail[-1].pop(parts[-1], None)
+        else:
+            trail[-1][parts[-1]] = value
+        for depth in range(len(trail) - 1, 0, -1):
+            if not trail[depth]:
+                trail[depth - 1].pop(parts[depth - 1])
+
+    def _children(self, path: str) -> tuple[dict, list[str]]:
+        node = self._node(path)
+        if not isinstance(node, dict):
+            return {}, []
+        ordered = self._ordered.get(path)
+        if ordered is None:
+            ordered = self._ordered[path] = sorted(node, key=self._key_order)
+        return node, ordered
+
+    async def _read(self, path: str) -> object|str|int|dict|None:
+        await asyncio.sleep(self.latency)
+        return _as_arrays(self._node(path))
+
+    async def _write(self, path: str, data: object) -> None:
+        await asyncio.sleep(self.latency)
+        self._set(path, data)
+
+    async def _update(self, path: str, data: dict) -> None:
+        await asyncio.sleep(self.latency)
+        paths = {tuple(self._parts(f"{path}/{key}")) for key in data}
+        for parts in paths:
+            if any(parts[:depth] in paths for depth in range(len(parts))):
+                raise ValueError(f"update of {'/'.join(parts)} overlaps an update of its ancestor")
+        for key, value in data.items():
+            self._set(f"{path}/{key}", value)
+
+    async def _delete(self, path: str) -> None:
+        await asyncio.sleep(self.latency)
+        self._set(path, None)
+
+    async def _transaction(self, path: str, func) -> object:
+        await asyncio.sleep(self.latency)
+        value = func(_as_arrays(self._node(path)))
+        self._set(path, value)
+        return value
+
+    async def _read_shallow(self, path: str) -> dict:
+        await asyncio.sleep(self.latency)
+        node = self._node(path)
+        if not isinstance(node, dict):
+            return {}
+        return {key: True if isinstance(value, dict) else value for key, value in node.items()}
+
+    async def _read_range(self, path: str, start: str | None, end: str | None) -> dict:
+        await asyncio.sleep(self.latency)
+        node, ordered = self._children(path)
+        low = 0 if start is None else bisect_left(ordered, self._key_order(start), key=self._key_order)
+        high = len(ordered) if end is None else bisect_right(ordered, self._key_order(end), key=self._key_order)
+        return {key: _as_arrays(node[key]) for key in ordered[low:high]}
+
+    async def _read_page(self, path: str, start_after: str | None, limit: int) -> dict:
+        await asyncio.sleep(self.latency)
+        node, ordered = self._children(path)
+        low = 0 if start_after is None else bisect_right(ordered, self._key_order(start_after), key=self._key_order)
+        return {key: _as_arrays(node[key]) for key in ordered[low:low + limit]}
+
+    def add_participants(self, lottery_id: str, users: range) -> None:
+        """
+        Bulk loads participants for a scenario's setup, bypassing the join path.
+        """
+        lottery = self._node(f"lotteries/{lottery_id}")
+        buckets = lottery.get("participant_buckets")
+        participants = {}
+        for user_id in users:
+            node = participants.setdefault(str(user_id % buckets), {}) if buckets else participants
+            node[str(user_id)] = f"user{user_id}"
+        self._set(f"lotteries/{lottery_id}/participants", participants)
+        self._set(f"lotteries/{lottery_id}/participant_count", len(users))
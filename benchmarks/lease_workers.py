@@ -0,0 +1,120 @@
+"""
+Several bot workers started by WorkerPool compete for the same overdue draws through
+Randomiser.finish_lottery and LeaseManager, backed by a SQLiteStorage database file shared
+between the processes. Worker 0 dies in the middle of its first draw, holding the lease,
+and the draw is taken over after the lease expires. Every lottery must be announced exactly once.
+
+    python -m benchmarks.lease_workers
+"""
+import asyncio
+import functools
+import os
+import tempfile
+import time
+from collections import Counter
+
+from telegram.ext import Application, ApplicationBuilder
+
+from benchmarks.fake_telegram import BOT_USERNAME, FakeBotAPI
+from bot.bot import Bot
+from bot.rate_limiter import PriorityRateLimiter
+from bot.workers import WorkerPool, current_worker
+from services.persistence import StoragePersistence
+from services.sqlite_storage import SQLiteStorage
+
+NUM_WORKERS = 4
+NUM_DRAWS = 50
+PARTICIPANTS = 5
+LEASE_TTL = 1.0
+TIMEOUT = 60
+
+
+class AnnouncementLog(FakeBotAPI):
+    """
+    Appends the chat of every winners announcement to a file shared by the workers.
+    With crash set the process dies on its first announcement, before it's sent.
+    """
+
+    def __init__(self, path: str, crash: bool) -> None:
+        super().__init__(latency=0.01)
+        self.path = path
+        self.crash = crash
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        params = request_data.parameters if request_data else {}
+        announcement = url.endswith("/sendMessage") and int(params["chat_id"]) < 0
+        if announcement and self.crash:
+            os._exit(1)
+        result = await super().do_request(url, method, request_data, **kwargs)
+        if announcement:
+            with open(self.path, "a") as log:
+                log.write(f"{params['chat_id']}\n")
+        return result
+
+
+def build_app(path: str, directory: str, builder: ApplicationBuilder) -> Application:
+    storage = SQLiteStorage(path)
+    api = AnnouncementLog(os.path.join(directory, "announcements"), crash=current_worker() == 0)
+
+    async def stagger(_: Application) -> None:
+        # The other workers start later, so worker 0 is the first to take a draw
+        if current_worker() != 0:
+            await asyncio.sleep(0.5)
+
+    async def close_storage(_: Application) -> None:
+        storage.close()
+
+    app = (builder.token("1:fake").request(api)
+           .persistence(StoragePersistence(storage))
+           .rate_limiter(PriorityRateLimiter(overall_rate=1000, group_rate=1000))
+           .post_init(stagger)
+           .post_shutdown(close_storage)
+           .build())
+    bot = Bot(app, storage, BOT_USERNAME, lease_ttl=LEASE_TTL, archive_dir=os.path.join(directory, "archive"))
+    # The schedule is rescanned every second instead of every minute, so the draw
+    # of the dead worker is retried soon after its lease expires
+    app.job_queue.run_repeating(bot.scheduler.load_due, interval=1, first=1)
+    return app
+
+
+async def setup(path: str) -> None:
+    storage = SQLiteStorage(path)
+    due_ts = int(time.time())
+    updates = {}
+    for draw in range(NUM_DRAWS):
+        updates[f"lotteries/l{draw}"] = {"owner": 1, "num_winners": 1, "publisher_chat_id": -1 - draw,
+                                         "participant_buckets": 4}
+        updates[f"schedule/{due_ts}/l{draw}"] = True
+    await storage.update_many(updates)
+    for draw in range(NUM_DRAWS):
+        for user_id in range(1, PARTICIPANTS + 1):
+            await storage.add_participant(f"l{draw}", user_id, f"user{user_id}")
+    storage.close()
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "lottery.db")
+        asyncio.run(setup(path))
+        storage = SQLiteStorage(path)
+        pool = WorkerPool(NUM_WORKERS, functools.partial(build_app, path, directory))
+        started = time.perf_counter()
+        pool.start()
+        while (asyncio.run(storage.read_shallow("lotteries")) and time.perf_counter() - started < TIMEOUT
+               and any(process.is_alive() for process in pool.processes)):
+            time.sleep(0.1)
+        elapsed = time.perf_counter() - started
+        pool.stop()
+        finished = asyncio.run(storage.read_shallow("finished"))
+        storage.close()
+        log = os.path.join(directory, "announcements")
+        announced = Counter(int(line) for line in open(log)) if os.path.exists(log) else Counter()
+        counts = [announced[-1 - draw] for draw in range(NUM_DRAWS)]
+        print(f"{NUM_WORKERS} workers, {NUM_DRAWS} draws, worker 0 crashed holding a lease")
+        print(f"exit codes: {[process.exitcode for process in pool.processes]}")
+        print(f"finished: {len(finished)}/{NUM_DRAWS}, every draw announced exactly once: "
+              f"{counts == [1] * NUM_DRAWS}, took {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Offline load simulation: the real Bot, Lottery and Randomiser handlers run against
+FakeBotAPI and FakeFirebase with the default rate limiter and admission control.
+Every scenario runs in its own process, so its peak memory is reported separately,
+and checks its outcome: the process exits with 1 if any scenario failed.
+
+    python -m benchmarks.simulation [clicks] [repeats] [deadline] [draw] [--scale 0.1]
+
+clicks:   10k users press "Участвовать" of one lottery at once
+repeats:  2k users press "Участвовать" 5 times each, one round after another
+deadline: 1k lotteries with 100 participants each end in the same second
+draw:     one draw over 1M participants
+"""
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timezone
+
+from telegram import Update
+from telegram.ext import Application
+
+from benchmarks.fake_telegram import BOT_USERNAME, FakeBotAPI, FakeFirebase
+from bot.admission import ADMITTED, COLLAPSED, AdmissionControl
+from bot.bot import Bot
+from bot.rate_limiter import PriorityRateLimiter
+from bot.scheduler import DrawScheduler
+from bot.update_processor import PerUserUpdateProcessor
+from services.persistence import StoragePersistence
+
+CHANNEL_ID = -100
+# Winners of the deadline scenario are announced to chats PUBLISHER_ID - i
+PUBLISHER_ID = -1000
+# Seconds a user waits before tapping again after being asked to try later
+RETRY_DELAY = 1.0
+MAX_WAVES = 50
+
+_update_ids = itertools.count()
+
+
+class RecordingAdmission(AdmissionControl):
+    """
+    Remembers the callback queries it sheds, so the simulated users can tap again.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.shed_queries: set[str] = set()
+
+    def admit(self, update: object) -> str:
+        result = super().admit(update)
+        if result != ADMITTED and isinstance(update, Update) and update.callback_query:
+            self.shed_queries.add(update.callback_query.id)
+        return result
+
+
+def build(api: FakeBotAPI, storage: FakeFirebase) -> tuple[Application, Bot]:
+    app = (Application.builder().token("1:fake").request(api).get_updates_request(api)
+           .persistence(StoragePersistence(storage))
+           .rate_limiter(PriorityRateLimiter())
+           .concurrent_updates(PerUserUpdateProcessor(64, RecordingAdmission()))
+           .build())
+    return app, Bot(app, storage, BOT_USERNAME, archive_dir=tempfile.mkdtemp(prefix="simulation-archive-"))
+
+
+def lottery(publisher_chat_id: int = CHANNEL_ID, until: datetime | None = None) -> dict:
+    data = {
+        "owner": 1,
+        "description": "simulation",
+        "linked_channels": [CHANNEL_ID],
+        "num_winners": 3,
+        "publisher_chat_id": publisher_chat_id,
+        "participant_buckets": 16,
+    }
+    if until:
+        data["until_date"] = until.isoformat()
+    return data
+
+
+def click(update_id: int, user_id: int, lottery_id: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "simulation",
+            "data": f"participate {lottery_id}",
+            "from": {"id": user_id, "is_bot": False, "first_name": "user", "username": f"user{user_id}"},
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": CHANNEL_ID, "type": "channel"}},
+        },
+    }
+
+
+async def process(app: Application, update: Update) -> float:
+    started = time.perf_counter()
+    await app.update_processor.process_update(update, app.process_update(update))
+    return time.perf_counter() - started
+
+
+async def tap(app: Application, user_ids: list[int], lottery_id: str) -> tuple[list[float], int]:
+    """
+    Every user taps "Участвовать" once, all at the same time. Users whose tap is shed by
+    admission control tap again RETRY_DELAY seconds later. Returns the latencies of all
+    the taps and the number of waves it took.
+    """
+    admission = app.update_processor.admission
+    latencies = []
+    for wave in range(1, MAX_WAVES + 1):
+        updates = [Update.de_json(click(next(_update_ids), user_id, lottery_id), app.bot) for user_id in user_ids]
+        latencies += await asyncio.gather(*(process(app, update) for update in updates))
+        user_ids = [update.callback_query.from_user.id for update in updates
+                    if update.callback_query.id in admission.shed_queries]
+        if not user_ids:
+            return latencies, wave
+        await asyncio.sleep(RETRY_DELAY)
+    raise AssertionError(f"{len(user_ids)} taps are still shed after {MAX_WAVES} waves")
+
+
+async def participant_ids(storage: FakeFirebase, lottery_id: str) -> list[int]:
+    return [int(user_id) async for user_id, _ in storage.iter_participants(lottery_id)]
+
+
+async def clicks(scale: float, api: FakeBotAPI, storage: FakeFirebase) -> dict:
+    count = int(10_000 * scale)
+    await storage.update_many({"lotteries/sim": lottery()})
+    app, _ = build(api, storage)
+    async with app:
+        await app.start()
+        started = time.perf_counter()
+        latencies, waves = await tap(app, list(range(1, count + 1)), "sim")
+        elapsed = time.perf_counter() - started
+        participants = await storage.get_participant_count("sim")
+        joined = await participant_ids(storage, "sim")
+        await app.stop()
+    assert participants == count, f"{participants} participants counted for {count} users"
+    assert sorted(joined) == list(range(1, count + 1)), f"{len(joined)} participants stored for {count} users"
+    return {"ops": len(latencies), "elapsed": elapsed, "latencies": latencies, "participants": participants,
+            "waves": waves, "admission": app.update_processor.admission.counts}
+
+
+async def repeats(scale: float, api: FakeBotAPI, storage: FakeFirebase) -> dict:
+    users = int(2_000 * scale)
+    await storage.update_many({"lotteries/sim": lottery()})
+    app, bot = build(api, storage)
+    async with app:
+        await app.start()
+        # Every round waits for the previous one, so no tap is collapsed into a
+        # tap of the same user still in process and all of them reach the handlers
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(5):
+            latencies += (await tap(app, list(range(1, users + 1)), "sim"))[0]
+        elapsed = time.perf_counter() - started
+        participants = await storage.get_participant_count("sim")
+        joined = await participant_ids(storage, "sim")
+        await app.stop()
+    counts = app.update_processor.admission.counts
+    assert participants == users, f"{participants} participants counted for {users} users"
+    assert sorted(joined) == list(range(1, users + 1)), f"{len(joined)} participants stored for {users} users"
+    assert counts[ADMITTED] == 5 * users and counts[COLLAPSED] == 0, f"admission: {counts}"
+    return {"ops": len(latencies), "elapsed": elapsed, "latencies": latencies, "participants": participants,
+            "index bytes": bot.participants.memory_usage(), "admission": counts}
+
+
+async def deadline(scale: float, api: FakeBotAPI, storage: FakeFirebase) -> dict:
+    count = int(1_000 * scale)
+    due_ts = int(time.time()) + 5
+    due = datetime.fromtimestamp(due_ts, timezone.utc)
+    updates = {}
+    for index in range(count):
+        updates[f"lotteries/sim{index}"] = lottery(PUBLISHER_ID - index, due)
+        updates |= DrawScheduler.index_entry(f"sim{index}", due)
+    await storage.update_many(updates)
+    for index in range(count):
+        storage.add_participants(f"sim{index}", range(1, 101))
+    app, _ = build(api, storage)
+    async with app:
+        await app.start()
+        due_monotonic = time.monotonic() + due_ts - time.time()
+        announced = []
+        while len(announced) < count and time.monotonic() < due_monotonic + 300:
+            await asyncio.sleep(0.1)
+            announced = [at for at, endpoint, params in api.log
+                         if endpoint == "sendMessage" and int(params["chat_id"]) <= PUBLISHER_ID]
+        await app.stop()
+    latencies = [max(at - due_monotonic, 0) for at in announced]
+    lotteries_left = await storage.read_shallow("lotteries")
+    finished = await storage.read("finished") or {}
+    assert len(announced) == count, f"{len(announced)} of {count} lotteries announced"
+    assert not lotteries_left, f"{len(lotteries_left)} lotteries left"
+    assert len(finished) == count, f"{len(finished)} of {count} results stored"
+    for lottery_id, result in finished.items():
+        winners = [user_id for user_id, _ in result["winners"]]
+        assert len(set(winners)) == 3, f"winners of {lottery_id}: {winners}"
+    return {"ops": len(announced), "elapsed": max(latencies, default=0), "latencies": latencies}
+
+
+async def draw(scale: float, api: FakeBotAPI, storage: FakeFirebase) -> dict:
+    count = int(1_000_000 * scale)
+    due_ts = int(time.time())
+    await storage.update_many({"lotteries/sim": lottery(), f"schedule/{due_ts}/sim": True})
+    storage.add_participants("sim", range(1, count + 1))
+    app, bot = build(api, storage)
+    async with app:
+        await app.start()
+        started = time.perf_counter()
+        await bot.randomiser.finish_lottery(app.bot, "sim", due_ts)
+        elapsed = time.perf_counter() - started
+        await app.stop()
+    result = await storage.read("finished/sim")
+    assert result, "the draw left no result"
+    winners = [user_id for user_id, _ in result["winners"]]
+    assert result["participant_count"] == count, f"{result['participant_count']} of {count} participants drawn"
+    assert len(set(winners)) == 3 and all(1 <= user_id <= count for user_id in winners), f"winners: {winners}"
+    return {"ops": count, "elapsed": elapsed, "latencies": [elapsed]}
+
+
+SCENARIOS = {"clicks": clicks, "repeats": repeats, "deadline": deadline, "draw": draw}
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def run_scenario(name: str, args: argparse.Namespace, results: multiprocessing.Queue) -> None:
+    api = FakeBotAPI(args.api_latency, args.retry_after_rate)
+    storage = FakeFirebase(args.storage_latency)
+    try:
+        result = asyncio.run(SCENARIOS[name](args.scale, api, storage))
+    except Exception as e:
+        traceback.print_exc()
+        result = {"ops": 0, "elapsed": 0, "latencies": [], "failed": f"{type(e).__name__}: {e}"}
+    result["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["calls"] = dict(api.calls)
+    result["flood_errors"] = api.flood_errors
+    results.put(result)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS), help=", ".join(SCENARIOS))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier of the scenario sizes")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="Bot API round-trip, s")
+    parser.add_argument("--storage-latency", type=float, default=0.02, help="storage round-trip, s")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of Bot API requests failing with 429")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    failed = False
+    print(f"{'scenario':>10} {'ops':>9} {'time, s':>9} {'ops/s':>9} {'p50, ms':>9} {'p99, ms':>9} {'peak RSS, MiB':>14}")
+    for name in args.scenarios:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_scenario, args=(name, args, results))
+        process.start()
+        result = results.get()
+        process.join()
+        ops, elapsed, latencies = result.pop("ops"), result.pop("elapsed"), result.pop("latencies")
+        print(f"{name:>10} {ops:>9} {elapsed:>9.2f} {ops / elapsed if elapsed else 0:>9.1f} "
+              f"{percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f} "
+              f"{result.pop('peak_rss'):>14.1f}")
+        print(f"{'':>10} {result}")
+        failed = failed or "failed" in result
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Update throughput of sequential processing (what polling did before) against
+PerUserUpdateProcessor, with handlers waiting on a simulated Firebase round-trip.
+
+    python -m benchmarks.update_throughput
+"""
+import asyncio
+import time
+from datetime import datetime
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+from telegram.ext import SimpleUpdateProcessor
+
+from bot.update_processor import PerUserUpdateProcessor
+
+NUM_UPDATES = 1000
+NUM_USERS = 500
+HANDLER_LATENCY = 0.02
+
+
+def make_update(update_id: int) -> Update:
+    user = User(id=update_id % NUM_USERS + 1, first_name="user", is_bot=False)
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=-100, type=Chat.CHANNEL))
+    query = CallbackQuery(id=str(update_id), from_user=user, chat_instance="bench",
+                          data="participate abcdef12", message=message)
+    return Update(update_id=update_id, callback_query=query)
+
+
+async def run(processor, updates: list[Update]) -> tuple[float, bool]:
+    seen: dict[int, list[int]] = {}
+
+    async def handler(update: Update) -> None:
+        await asyncio.sleep(HANDLER_LATENCY)
+        seen.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    started = time.perf_counter()
+    async with processor:
+        # Application starts a task per update in arrival order
+        tasks = [asyncio.create_task(processor.process_update(update, handler(update))) for update in updates]
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    in_order = all(ids == sorted(ids) for ids in seen.values())
+    return elapsed, in_order
+
+
+async def main() -> None:
+    updates = [make_update(i) for i in range(NUM_UPDATES)]
+    print(f"{NUM_UPDATES} updates from {NUM_USERS} users, {HANDLER_LATENCY * 1000:.0f} ms per handler")
+    for name, processor in (("sequential", SimpleUpdateProcessor(1)),
+                            ("per-user, 64", PerUserUpdateProcessor(64)),
+                            ("per-user, 256", PerUserUpdateProcessor(256))):
+        elapsed, in_order = await run(processor, updates)
+        print(f"{name:>14}: {NUM_UPDATES / elapsed:8.1f} updates/s, per-user order kept: {in_order}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
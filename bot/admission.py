@@ -0,0 +1,95 @@
+import logging
+import time
+
+from telegram import Update
+from telegram.error import TelegramError
+
+from services.metrics import metrics
+from services.rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+ADMISSION = metrics.counter("admission_total", "Updates admitted to handlers or shed by admission control")
+
+ADMITTED = "admitted"
+THROTTLED = "throttled"
+COLLAPSED = "collapsed"
+OVERLOADED = "overloaded"
+
+
+class AdmissionControl:
+    """
+    Decides whether an update reaches the handlers:
+    - every user has a token bucket of user_rate updates per second with bursts of user_burst,
+    - a callback query identical to one of the same user still in process is dropped,
+    - at most max_in_flight admitted updates are in process or waiting, the rest is shed.
+    Shed callback queries are answered right away, so the client asks to try again instead of spinning.
+    Updates without a user, e.g. the bot being added to a channel, are always admitted.
+    """
+
+    def __init__(self, max_in_flight: int = 1024, user_rate: float = 2, user_burst: float = 10) -> None:
+        self.max_in_flight = max_in_flight
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.in_flight = 0
+        self.counts = {ADMITTED: 0, THROTTLED: 0, COLLAPSED: 0, OVERLOADED: 0}
+        self._users: dict[int, TokenBucket] = {}
+        self._callbacks: set[tuple[int, str, int | None]] = set()
+
+    @staticmethod
+    def _callback_key(update: Update) -> tuple[int, str, int | None] | None:
+        query = update.callback_query
+        if query is None:
+            return None
+        return query.from_user.id, query.data or "", query.message.message_id if query.message else None
+
+    def _user_bucket(self, user_id: int, now: float) -> TokenBucket:
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            if len(self._users) > 10_000:
+                self._users = {key: value for key, value in self._users.items() if not value.is_full(now)}
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    def admit(self, update: object) -> str:
+        """
+        Returns ADMITTED or the reason the update is shed. Admitted updates must be released.
+        """
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None or update.my_chat_member or update.chat_member:
+            result = ADMITTED
+        elif self.in_flight >= self.max_in_flight:
+            result = OVERLOADED
+        elif self._callback_key(update) in self._callbacks:
+            result = COLLAPSED
+        elif not self._user_bucket(user.id, time.monotonic()).consume():
+            result = THROTTLED
+        else:
+            result = ADMITTED
+        if result == ADMITTED:
+            self.in_flight += 1
+            key = self._callback_key(update) if isinstance(update, Update) else None
+            if key is not None:
+                self._callbacks.add(key)
+        self.counts[result] += 1
+        ADMISSION.inc(result=result)
+        return result
+
+    def release(self, update: object) -> None:
+        self.in_flight -= 1
+        if isinstance(update, Update):
+            self._callbacks.discard(self._callback_key(update))
+
+    @staticmethod
+    async def shed(update: object, reason: str) -> None:
+        if not isinstance(update, Update):
+            return
+        try:
+            if update.callback_query:
+                # A collapsed duplicate only stops the button's spinner, the original shows the result
+                await update.callback_query.answer(
+                    None if reason == COLLAPSED else "Слишком много запросов, попробуйте ещё раз")
+            elif reason == OVERLOADED and update.effective_message:
+                await update.effective_message.reply_text("Бот перегружен, попробуйте ещё раз через минуту.")
+        except TelegramError as e:
+            logger.warning(f"can't answer shed update: {e}")
@@ -1,25 +1,75 @@
+import logging
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (Application, ContextTypes, CommandHandler,
-                          ChatMemberHandler)
+                          ChatMemberHandler, TypeHandler)
 from telegram.constants import ChatMemberStatus, ChatType
 
 from bot.lottery import Lottery
+from bot.maintenance import Maintenance
+from bot.membership import MembershipChecker
+from bot.participants import ParticipantIndex
 from bot.randomiser import Randomiser
-from services.firebase import FirebaseClient
-from services.utils import decode_payload
+from bot.scheduler import DrawScheduler
+from bot.stats import JoinStats, render_stats
+from bot.workers import current_worker, send_to_worker, worker_of
+from services.archive import Archive
+from services.storage import LotteryNotFound, Storage
+from services.lease import LeaseManager
+from services.metrics import metrics, timed_handler
+from services.utils import decode_payload, payload_secret
+
+logger = logging.getLogger(__name__)
+
+LINKS_REJECTED = metrics.counter("deep_links_rejected_total", "Mangled, forged or expired /start links")
+
+
+@dataclass
+class ChannelsChanged:
+    """
+    Sent to the worker of user_ids when their channels were changed by another worker.
+    """
+    user_ids: list[int]
+
 
 class Bot:
-    def __init__(self, app: Application, firebase: FirebaseClient, bot_username: str) -> None:
+    def __init__(self, app: Application, storage: Storage, bot_username: str,
+                 button_edit_window: float = 3.0, lease_ttl: float = 60, link_secret: str | None = None,
+                 archive_dir: str = "archive", draft_ttl: float = 7 * 24 * 3600) -> None:
         if bot_username is None:
             raise TypeError("Bot username cannot be None")
         self.bot_username = bot_username
-        self.randomiser = Randomiser(firebase)
-        self.lottery = Lottery(firebase, self.randomiser, self.bot_username)
-        self.firebase_db = firebase
+        leases = LeaseManager(storage, lease_ttl)
+        self.randomiser = Randomiser(storage, leases)
+        self.scheduler = DrawScheduler(storage, self.randomiser)
+        self.membership = MembershipChecker()
+        self.participants = ParticipantIndex(storage)
+        self.join_stats = JoinStats(storage)
+        # Links are signed with the bot token unless a separate secret is given
+        self.link_secret = payload_secret(link_secret or app.bot.token)
+        self.lottery = Lottery(storage, self.randomiser, self.scheduler, self.membership, self.participants,
+                               self.join_stats, self.bot_username, button_edit_window, self.link_secret)
+        self.storage = storage
         for h in self.lottery.get_handlers():
             app.add_handler(h)
         app.add_handler(ChatMemberHandler(self.invitation))
+        app.add_handler(TypeHandler(ChannelsChanged, self.channels_changed))
         app.add_handler(CommandHandler("start", self.start))
+        app.add_handler(CommandHandler("stats", self.stats))
+        # The first scan is a separate job: an interval trigger added before the application
+        # starts skips its first run, and APScheduler drops jobs over a second late by default
+        app.job_queue.run_once(self.scheduler.load_due, when=0, job_kwargs={"misfire_grace_time": None})
+        app.job_queue.run_repeating(self.scheduler.load_due, interval=self.scheduler.interval,
+                                    first=self.scheduler.interval)
+        self.maintenance = Maintenance(storage, Archive(archive_dir), leases, draft_ttl,
+                                       archive_delay=2 * self.join_stats.interval)
+        app.job_queue.run_repeating(self.maintenance.run, interval=self.maintenance.interval,
+                                    first=self.maintenance.interval)
+        app.job_queue.run_repeating(self.join_stats.flush, interval=self.join_stats.interval,
+                                    first=self.join_stats.interval)
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message when the command /start is issued."""
@@ -36,60 +86,117 @@ class Bot:
             reply_markup=keyboard
         )
 
+    @timed_handler
+    async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Send the join statistics of a lottery to its owner when the command /stats <lottery_id> is issued."""
+        if not context.args or not re.fullmatch(r"\w+", context.args[0]):
+            await update.message.reply_text("Укажите ID розыгрыша: /stats <ID>")
+            return
+        lottery_id = context.args[0]
+        live = await self.storage.get_lottery(lottery_id)
+        lottery = live or await self.storage.read(f"finished/{lottery_id}") \
+            or await self.maintenance.get_archived(lottery_id)
+        if not lottery or lottery.get("owner") != update.effective_user.id:
+            await update.message.reply_text("Розыгрыш не найден.")
+            return
+        if "joins_by_hour" in lottery:
+            # Archived lotteries keep only the hourly counts
+            minutes, hours = {}, {int(bucket): count for bucket, count in lottery["joins_by_hour"].items()}
+        else:
+            minutes, hours = await self.join_stats.get(lottery_id)
+        if live:
+            participant_count = await self.storage.get_participant_count(lottery_id)
+        else:
+            participant_count = lottery.get("participant_count", 0)
+        await update.message.reply_text(render_stats(lottery_id, participant_count, minutes, hours))
+
+    @timed_handler
     async def invitation(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.my_chat_member.from_user
+        chat = update.my_chat_member.chat
+        if chat.type == ChatType.PRIVATE:
+            return
         match ChatMemberStatus(update.my_chat_member.new_chat_member.status):
             case ChatMemberStatus.MEMBER | ChatMemberStatus.ADMINISTRATOR as status:
-                user = update.my_chat_member.from_user
-                chat = update.my_chat_member.chat
-                if chat.type != ChatType.PRIVATE:
-                    channels = await self.firebase_db.get_user_channels(user.id)
-                    entry = {
-                        "chat_id": chat.id,
-                        "username": chat.mention_html()
-                    }
-
-                    updated = False
-                    for ch in channels:
-                        if ch["chat_id"] == chat.id:
-                            ch["status"] = status
-                            updated = True
-                            break
-
-                    if not updated:
-                        entry["status"] = status
-                        channels.append(entry)
-
-                    await self.firebase_db.set_user_channels(user.id, channels)
-                    await self.lottery.update_channel_list_message(update, context)
+                owners = await self.storage.add_user_channel(user.id, {
+                    "chat_id": chat.id,
+                    "title": chat.title,
+                    "username": chat.mention_html(),
+                    "status": status
+                })
+                self.drop_channels_caches(context.application, owners)
+                await self.lottery.update_channel_list_message(update, context)
 
             case ChatMemberStatus.LEFT | ChatMemberStatus.BANNED:
-                user = update.my_chat_member.from_user
-                chat = update.my_chat_member.chat
-                if chat.type != ChatType.PRIVATE:
-                    channels = await self.firebase_db.get_user_channels(user.id)
-                    del_channels = [ch for ch in range(len(channels)) if channels[ch]["chat_id"] == chat.id]
-                    for ch in del_channels:
-                        await self.firebase_db.delete(f"users/{user.id}/channels/{ch}")
-                    await self.lottery.update_channel_list_message(update, context)
+                owners = await self.storage.remove_channel(chat.id, user.id)
+                self.drop_channels_caches(context.application, owners + [user.id])
+                await self.lottery.update_channel_list_message(update, context)
             case _:
                 pass
 
+    def drop_channels_caches(self, application: Application, user_ids: list[int]) -> None:
+        """
+        Drops the cached channels of the users. user_data of users handled by other workers
+        is never touched here, their workers are asked to drop it instead.
+        """
+        remote = defaultdict(list)
+        local = []
+        for user_id in user_ids:
+            index = worker_of(user_id)
+            if index == current_worker():
+                local.append(user_id)
+            else:
+                remote[index].append(user_id)
+        for index, ids in remote.items():
+            send_to_worker(index, ChannelsChanged(ids))
+        # Marking a user without data here would persist an empty user_data over theirs
+        loaded = [user_id for user_id in local if user_id in application.user_data]
+        for user_id in loaded:
+            self.lottery.drop_channels_cache(application.user_data[user_id])
+        if loaded:
+            application.mark_data_for_update_persistence(user_ids=loaded)
+
+    async def channels_changed(self, update: ChannelsChanged, context: ContextTypes.DEFAULT_TYPE) -> None:
+        self.drop_channels_caches(context.application, update.user_ids)
+
+    @timed_handler
     async def join_lot(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        user_id = update.effective_user.id
-        data = decode_payload(context.args[0])
-        owner_id = data["user_id"]
+        user = update.effective_user
+        # Forged, stale and mangled links are rejected before any request
+        data = decode_payload(context.args[0], self.link_secret)
+        if data is None:
+            LINKS_REJECTED.inc()
+            await update.message.reply_text("Ссылка на розыгрыш недействительна или устарела.")
+            return
         lottery_id = data["lottery_id"]
-        this_lottery = await self.firebase_db.read(f"lotteries/{owner_id}/{lottery_id}") or []
+        this_lottery = await self.storage.get_lottery(lottery_id)
+        if not this_lottery:
+            await context.bot.send_message(chat_id=update.effective_chat.id,
+                                           text="Розыгрыш не существует или уже завершен!")
+            return
+        if await self.participants.contains(lottery_id, user.id):
+            await update.message.reply_text(f"Вы уже участвуете в розыгрыше с ID {lottery_id}!")
+            return
         publisher_chat_id = this_lottery["publisher_chat_id"]
-        member = await context.bot.get_chat_member(chat_id=publisher_chat_id, user_id=user_id)
-        if member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR]:
-            if not this_lottery:
-                await context.bot.send_message(chat_id=update.effective_chat.id,
-                                               text="Розыгрыш не существует или уже завершен!")
+        if await self.membership.is_member(context.bot, publisher_chat_id, user.id):
+            try:
+                members = await self.storage.add_participant(lottery_id, user.id, user.username)
+            except LotteryNotFound:
+                await update.message.reply_text("Розыгрыш не существует или уже завершен!")
+                return
+            except Exception as e:
+                logger.error(f"can't add participant {user.id} to lottery {lottery_id}: {e}")
+                await update.message.reply_text("Не удалось записаться в розыгрыш, попробуйте ещё раз")
+                return
+            self.participants.add(lottery_id, user.id)
+            if members is None:
+                await update.message.reply_text(f"Вы уже участвуете в розыгрыше с ID {lottery_id}!")
+                return
+            self.join_stats.record(lottery_id)
+            # Only this join sees the goal, the draw is started before any Bot API call can fail
+            await self.randomiser.check_lottery_goal(context, lottery_id, this_lottery, members)
             await update.message.reply_text(f"Вы присоединились к розыгрышу с ID {lottery_id}!")
-            await self.firebase_db.update(f"lotteries/{owner_id}/{lottery_id}/participants/",
-                                          {update.effective_user.id: update.effective_user.username})
             return
 
         await context.bot.send_message(chat_id=update.effective_chat.id,
-                                       text="Для участия в розыгрыше необходимо быть участником канала:")
\ No newline at end of file
+                                       text="Для участия в розыгрыше необходимо быть участником канала:")
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class _ButtonState:
+    def __init__(self, lottery_id: str) -> None:
+        self.lottery_id = lottery_id
+        self.pending = 0
+        self.shown: int | None = None
+        self.task: asyncio.Task | None = None
+
+
+class ParticipateButtonUpdater:
+    """
+    Coalesces edits of the "Участвовать (N)" button: the newest participant count
+    of a message is sent at most once per window, the rest is dropped.
+    """
+
+    def __init__(self, window: float = 3.0) -> None:
+        self.window = window
+        self._states: dict[tuple[int, int], _ButtonState] = {}
+
+    def schedule(self, bot: Bot, chat_id: int, message_id: int, lottery_id: str, members: int) -> None:
+        key = (chat_id, message_id)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _ButtonState(lottery_id)
+        # Counts only grow, an older click may report its count after a newer one
+        state.pending = max(state.pending, members)
+        if state.task is None:
+            state.task = asyncio.create_task(self._flush(bot, key, state))
+
+    async def _flush(self, bot: Bot, key: tuple[int, int], state: _ButtonState) -> None:
+        chat_id, message_id = key
+        try:
+            while state.pending != state.shown:
+                members = state.pending
+                keyboard = [[InlineKeyboardButton(text=f"Участвовать ({members})",
+                                                  callback_data=f"participate {state.lottery_id}")]]
+                try:
+                    await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id,
+                                                        reply_markup=InlineKeyboardMarkup(keyboard))
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    logger.warning(f"flood wait {retry_after}s on participate button {key}")
+                    await asyncio.sleep(retry_after)
+                    continue
+                except BadRequest as e:
+                    if "not modified" not in e.message:
+                        logger.warning(f"can't update participate button {key}: {e}")
+                        return
+                except TelegramError as e:
+                    logger.warning(f"can't update participate button {key}: {e}")
+                    return
+                state.shown = members
+                await asyncio.sleep(self.window)
+        finally:
+            del self._states[key]
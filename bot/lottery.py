@@ -1,6 +1,9 @@
+import time
 import uuid
 from datetime import datetime
+from functools import wraps
 from enum import Enum
+from typing import TypedDict
 from zoneinfo import ZoneInfo
 import re
 import logging
@@ -11,9 +14,15 @@ from telegram.ext import ConversationHandler, CommandHandler, CallbackQueryHandl
     filters, ContextTypes
 from telegram.error import TelegramError
 
+from bot.button_updater import ParticipateButtonUpdater
+from bot.membership import MembershipChecker
+from bot.participants import ParticipantIndex
 from bot.randomiser import Randomiser
+from bot.scheduler import DrawScheduler
+from bot.stats import JoinStats
+from services.metrics import timed_handler
 from services.utils import encode_payload
-from services.firebase import FirebaseClient
+from services.storage import LotteryNotFound, Storage
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +40,40 @@ def parse_date(date_str: str) -> datetime | None:
         return None
 
 
+def requires_draft(func):
+    """
+    Ends the conversation if its draft was removed by Maintenance after the draft TTL.
+    """
+    @wraps(func)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if "draft" not in context.user_data:
+            if update.callback_query:
+                await update.callback_query.answer()
+            await update.effective_chat.send_message("Черновик розыгрыша устарел, создайте розыгрыш заново.")
+            return ConversationHandler.END
+        return await func(self, update, context)
+    return wrapper
+
+
+class LotteryDraft(TypedDict, total=False):
+    """
+    Lottery being created, kept in user_data until it is published.
+    Fields holding None or empty lists are dropped when the draft is persisted, so all
+    but lottery_id and owner may be missing.
+    """
+    lottery_id: str
+    owner: int
+    created: int
+    description: str | None
+    photo_id: str | None
+    linked_channels: list[int]
+    num_winners: int
+    until_date: str
+    max_count: int
+    publisher_chat_id: int
+    participant_buckets: int
+
+
 class Lottery:
     class NewLotteryState(Enum):
         READY = 0
@@ -42,9 +85,24 @@ class Lottery:
         COUNT = 6
         PUBLISHER = 7
 
-    def __init__(self, firebase: FirebaseClient, randomiser: Randomiser, bot_username: str):
-        self.firebase_db = firebase
+    def __init__(self, storage: Storage, randomiser: Randomiser, scheduler: DrawScheduler,
+                 membership: MembershipChecker, participants: ParticipantIndex, join_stats: JoinStats,
+                 bot_username: str, button_edit_window: float = 3.0,
+                 link_secret: bytes = b"", link_ttl: int = 30 * 24 * 3600):
+        """
+        link_secret: Key signing the /start links of published lotteries.
+        link_ttl: Time in seconds the link of a lottery without an end date stays valid.
+        """
+        self.storage = storage
+        self.bot_username = bot_username
+        self.link_secret = link_secret
+        self.link_ttl = link_ttl
         self.randomise_job = randomiser
+        self.scheduler = scheduler
+        self.membership = membership
+        self.participants = participants
+        self.join_stats = join_stats
+        self.button_updater = ParticipateButtonUpdater(button_edit_window)
         self.mode_keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("Закончить по дате", callback_data="mode_date")],
             [InlineKeyboardButton("Закончить по числу участников", callback_data="mode_count")],
@@ -64,6 +122,19 @@ class Lottery:
         self.lottery_count_guide = "Отлично! Теперь выберите количество участников, при достижении которого розыгрыш будет заканчиваться."
         self.lottery_publisher_guide = "Отлично! Выберите канал, который опубликует результаты розыгрыша."
 
+    async def get_user_channels(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> list:
+        """
+        Каналы пользователя, закешированные в user_data на время создания розыгрыша.
+        Кеш сбрасывается в Bot.invitation при изменении каналов.
+        """
+        channels = context.user_data.get("channels")
+        if channels is None:
+            channels = await self.storage.get_user_channels(update.effective_user.id)
+            context.user_data["channels"] = channels
+            context.user_data["channel_rows"] = [[channel["title"], str(channel["chat_id"])]
+                                                 for channel in channels]
+        return channels
+
     async def get_publisher_channels_keyboard(
             self, update: Update,
             context: ContextTypes.DEFAULT_TYPE,
@@ -73,15 +144,12 @@ class Lottery:
         """
         Возвращает клавиатуру с каналами пользователя, которые могут быть выбраны в качестве публикатора.
         """
-        channels = await self.firebase_db.get_user_channels(update.effective_user.id)
+        await self.get_user_channels(update, context)
         keyboard = []
-        for i, channel in enumerate(channels):
-            match = re.search(r'>([^<]+)<', channel["username"])
-            title = match.group(1) if match else "Канал"
-            if marked is not None and channel["chat_id"] in marked:
+        for title, chat_id in context.user_data["channel_rows"]:
+            if marked is not None and int(chat_id) in marked:
                 title += " ✔️"
-            button = InlineKeyboardButton(text=title, callback_data=f"{channel['chat_id']}")
-            keyboard.append([button])
+            keyboard.append([InlineKeyboardButton(text=title, callback_data=chat_id)])
         if ready_button:
             keyboard.append([InlineKeyboardButton("Готово", callback_data="ready")])
         keyboard.append([InlineKeyboardButton("Назад", callback_data="back_data")])
@@ -127,6 +195,10 @@ class Lottery:
                     ]
                 },
                 fallbacks=[],
+                # A new lottery can be started from any step, e.g. after its draft expired
+                allow_reentry=True,
+                name="new_lottery",
+                persistent=True,
             ),
             CallbackQueryHandler(self.participate_callback, pattern=r"^participate (\w+)$"),
         ]
@@ -134,7 +206,7 @@ class Lottery:
     async def create_channel_list_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Готово", callback_data="ready")]])
         user_id = update.effective_user.id
-        channels = await self.firebase_db.get_user_channels(user_id)
+        channels = await self.get_user_channels(update, context)
         message = await update.message.reply_text(
             "Для начала добавьте бота как администратора во все каналы, "
             "которые будут организаторами розыгрыша.\n\nВаши каналы, в которых есть бот:\n" +
@@ -143,13 +215,13 @@ class Lottery:
             parse_mode="HTML",
             disable_web_page_preview=True
         )
-        await self.firebase_db.update(f"users/{user_id}", {"added_channels_message": message.message_id})
+        await self.storage.update(f"users/{user_id}", {"added_channels_message": message.message_id})
 
     async def update_channel_list_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user = update.my_chat_member.from_user
         user_id = user.id
-        channels = await self.firebase_db.get_user_channels(user_id)
-        added_msg_id = (await self.firebase_db.read(f"users/{user_id}/added_channels_message")) or 0
+        channels = await self.get_user_channels(update, context)
+        added_msg_id = (await self.storage.read(f"users/{user_id}/added_channels_message")) or 0
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Начать", callback_data="ready")]])
         await context.bot.edit_message_text(
             chat_id=user_id,
@@ -162,16 +234,30 @@ class Lottery:
             disable_web_page_preview=True
         )
 
+    @staticmethod
+    def drop_channels_cache(user_data: dict | None) -> None:
+        if user_data is not None:
+            user_data.pop("channels", None)
+            user_data.pop("channel_rows", None)
+
+    @timed_handler
     async def new_lot(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        context.user_data["lottery_id"] = str(uuid.uuid4())[:8]
+        self.drop_channels_cache(context.user_data)
+        context.user_data["draft"] = LotteryDraft(
+            lottery_id=str(uuid.uuid4())[:8],
+            owner=update.effective_user.id,
+            created=int(time.time()),
+            linked_channels=[],
+        )
         await self.create_channel_list_message(update, context)
         return self.NewLotteryState.READY.value
 
+    @timed_handler
+    @requires_draft
     async def setup_lot(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info("creating new lottery")
         query = update.callback_query
-        user_id = update.effective_user.id
-        channels = await self.firebase_db.get_user_channels(user_id)
+        channels = await self.get_user_channels(update, context)
 
         if not channels:
             await query.answer("Добавьте бота как администратора хотя бы в один канал!", show_alert=True)
@@ -183,6 +269,8 @@ class Lottery:
         await query.edit_message_text(self.lottery_text_guide)
         return self.NewLotteryState.TEXT.value
 
+    @timed_handler
+    @requires_draft
     async def lottery_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logger.info("adding text")
         message = update.message
@@ -194,44 +282,49 @@ class Lottery:
         elif message.document and message.document.mime_type.startswith("image/"):
             photo_file_id = message.document.file_id
 
-        await self.firebase_db.write(f"lotteries/{context.user_data['lottery_id']}", {
-            "owner": update.effective_user.id,
-            "description": description,
-            "photo_id": photo_file_id,
-        })
+        draft: LotteryDraft = context.user_data["draft"]
+        draft["description"] = description
+        draft["photo_id"] = photo_file_id
 
         keyboard = await self.get_publisher_channels_keyboard(update, context, ready_button=True)
         await update.message.reply_text(self.lottery_linked_channels_guide, reply_markup=InlineKeyboardMarkup(keyboard))
         return self.NewLotteryState.LINKED_CHANNELS.value
 
+    @timed_handler
+    @requires_draft
     async def add_linked_channels(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logger.info("adding linked channels")
         query = update.callback_query
         data = query.data
         await query.answer()
-        ud = context.user_data
-        ud.setdefault("linked_channels", [])
+        draft: LotteryDraft = context.user_data["draft"]
         if data == "ready":
-            await self.firebase_db.update(f"lotteries/{context.user_data['lottery_id']}", {
-                "linked_channels": ud["linked_channels"]
-            })
             await query.edit_message_text(self.lottery_num_winners_guide)
             await query.edit_message_reply_markup(self.back_keyboard)
             return self.NewLotteryState.NUM_WINNERS.value
         elif data == "back_data":
             await query.edit_message_text(self.lottery_text_guide)
             return self.NewLotteryState.TEXT.value
-        data = int(data)
-        if data not in ud["linked_channels"]:
-            ud["linked_channels"].append(data)
+        chat_id = int(data)
+        # Empty lists don't survive persistence, a reloaded draft may have no linked_channels
+        linked_channels = draft.setdefault("linked_channels", [])
+        if chat_id not in linked_channels:
+            linked_channels.append(chat_id)
         else:
-            ud["linked_channels"].remove(data)
-        await query.edit_message_reply_markup(
-            InlineKeyboardMarkup(
-                await self.get_publisher_channels_keyboard(update, context, ud["linked_channels"], ready_button=True))
-        )
+            linked_channels.remove(chat_id)
+        # Only the checkmark of the toggled channel changes, the rest of the keyboard is reused as is
+        keyboard = [list(row) for row in query.message.reply_markup.inline_keyboard]
+        for row in keyboard:
+            if row[0].callback_data == data:
+                title = row[0].text.removesuffix(" ✔️")
+                if chat_id in linked_channels:
+                    title += " ✔️"
+                row[0] = InlineKeyboardButton(text=title, callback_data=data)
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
         return self.NewLotteryState.LINKED_CHANNELS.value
 
+    @timed_handler
+    @requires_draft
     async def lottery_num_winners(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logger.info("adding num_winners")
         if update.callback_query:
@@ -245,9 +338,7 @@ class Lottery:
 
         num_winners = update.message.text
         if num_winners.isdigit():
-            await self.firebase_db.update(f"lotteries/{context.user_data['lottery_id']}", {
-                "num_winners": int(num_winners)
-            })
+            context.user_data["draft"]["num_winners"] = int(num_winners)
             await update.message.reply_text(self.lottery_mode_guide, reply_markup=self.mode_keyboard)
             return self.NewLotteryState.MODE.value
 
@@ -256,14 +347,19 @@ class Lottery:
         return self.NewLotteryState.NUM_WINNERS.value
 
 
+    @timed_handler
+    @requires_draft
     async def lottery_mode(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logger.info("setting mode")
         query = update.callback_query
 
+        draft: LotteryDraft = context.user_data["draft"]
         if query.data == "mode_date":
+            draft.pop("max_count", None)
             await query.edit_message_text(self.lottery_date_guide, reply_markup=self.back_keyboard)
             return self.NewLotteryState.DATE.value
         elif query.data == "mode_count":
+            draft.pop("until_date", None)
             await query.edit_message_text(self.lottery_count_guide,
                                           reply_markup=self.back_keyboard)
             return self.NewLotteryState.COUNT.value
@@ -273,6 +369,8 @@ class Lottery:
         return self.NewLotteryState.NUM_WINNERS.value
 
 
+    @timed_handler
+    @requires_draft
     async def lottery_count(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logger.info("setting mode: count")
         if update.callback_query:
@@ -286,9 +384,7 @@ class Lottery:
         count_str = update.message.text
         publisher_keyboard = await self.get_publisher_channels_keyboard(update, context)
         if count_str.isdigit():
-            await self.firebase_db.update(f"lotteries/{context.user_data['lottery_id']}", {
-                "max_count": int(count_str),
-            })
+            context.user_data["draft"]["max_count"] = int(count_str)
             await update.message.reply_text(self.lottery_publisher_guide,
                                             reply_markup=InlineKeyboardMarkup(publisher_keyboard))
             return self.NewLotteryState.PUBLISHER.value
@@ -298,6 +394,8 @@ class Lottery:
         return self.NewLotteryState.COUNT.value
 
 
+    @timed_handler
+    @requires_draft
     async def lottery_date(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logger.info("setting mode: date")
         if update.callback_query:
@@ -311,12 +409,9 @@ class Lottery:
         date_str = update.message.text
         utc_time = parse_date(date_str)
 
-        await self.firebase_db.update(f"lotteries/{context.user_data['lottery_id']}", {
-            "until_date": utc_time.isoformat()
-        })
-
-        publisher_keyboard = await self.get_publisher_channels_keyboard(update, context)
         if utc_time:
+            context.user_data["draft"]["until_date"] = utc_time.isoformat()
+            publisher_keyboard = await self.get_publisher_channels_keyboard(update, context)
             await update.message.reply_text(self.lottery_publisher_guide,
                                             reply_markup=InlineKeyboardMarkup(publisher_keyboard))
             return self.NewLotteryState.PUBLISHER.value
@@ -325,6 +420,8 @@ class Lottery:
             "Не удалось распознать дату." + self.lottery_date_guide, reply_markup=self.back_keyboard)
         return self.NewLotteryState.DATE.value
 
+    @timed_handler
+    @requires_draft
     async def lottery_publisher(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logger.info(f"adding publisher channel: {update.callback_query.data}")
         query = update.callback_query
@@ -335,54 +432,50 @@ class Lottery:
                                           reply_markup=self.mode_keyboard)
             return self.NewLotteryState.MODE.value
 
-        await self.firebase_db.update(f"lotteries/{context.user_data['lottery_id']}", {
-            "publisher_chat_id": int(query.data)
-        })
-        await self.publish_lottery(update, context)
+        context.user_data["draft"]["publisher_chat_id"] = int(query.data)
+        if not await self.publish_lottery(update, context):
+            return self.NewLotteryState.PUBLISHER.value
         return ConversationHandler.END
 
-    async def publish_lottery(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    @timed_handler
+    async def publish_lottery(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """
+        Commits the draft and announces the lottery. Returns False if the commit failed,
+        the draft is kept then, so the user can retry.
+        """
         logger.info("publishing lottery")
-        lottery_id = context.user_data["lottery_id"]
-        description = await self.firebase_db.read(
-            f"lotteries/{lottery_id}/description")
-        chat_id = await self.firebase_db.read(
-            f"lotteries/{lottery_id}/publisher_chat_id")
-        num_winners = await self.firebase_db.read(
-            f"lotteries/{lottery_id}/num_winners"
-        )
-        date = await self.firebase_db.read(
-            f"lotteries/{lottery_id}/until_date")
+        lottery: LotteryDraft = dict(context.user_data["draft"])
+        lottery_id = lottery.pop("lottery_id")
+        lottery["participant_buckets"] = self.storage.participant_buckets
+        # Joins check that the counter exists, so they don't recreate a drawn lottery
+        lottery["participant_count"] = 0
+        # The whole lottery and its schedule entry are committed at once,
+        # abandoned drafts never reach the database
+        updates = {f"lotteries/{lottery_id}": lottery}
+        date = lottery.get("until_date")
         if date:
             date = datetime.fromisoformat(date)
-            context.job_queue.run_once(self.randomise_job.date_result, when=date, data=
-            {
-                "owner_id": update.effective_user.id,
-                "lottery_id": lottery_id,
-                "publisher_chat_id": chat_id,
-                "num_winners": num_winners
-            })
-        max_count = await self.firebase_db.read(
-            f"lotteries/{lottery_id}/max_count"
-        )
-        if max_count:
-            interval_seconds = 30
-            context.job_queue.run_repeating(
-                self.randomise_job.check_lottery_count,
-                interval=interval_seconds,
-                first=0,
-                data={
-                    "owner_id": update.effective_user.id,
-                    "lottery_id": lottery_id,
-                    "goal_participants": max_count,
-                    "publisher_chat_id": chat_id,
-                    "num_winners": num_winners
-                }
-            )
+            updates |= self.scheduler.index_entry(lottery_id, date)
+        try:
+            await self.storage.update_many(updates)
+        except Exception as e:
+            logger.error(f"can't publish lottery {lottery_id}: {e}")
+            await update.effective_chat.send_message("Не удалось опубликовать розыгрыш, выберите канал ещё раз.")
+            return False
+        context.user_data.pop("draft", None)
+        self.drop_channels_cache(context.user_data)
+        if date:
+            self.scheduler.add_draw(context.job_queue, lottery_id, date)
+
+        chat_id = lottery["publisher_chat_id"]
+        description = lottery.get("description")
+        expires = int(date.timestamp()) if date else int(time.time()) + self.link_ttl
+        payload = encode_payload(update.effective_user.id, lottery_id, expires, self.link_secret)
         await context.bot.send_message(chat_id=update.effective_user.id,
-                                       text=f"Розыгрыш успешно опубликован!\n")
+                                       text=f"Розыгрыш успешно опубликован!\n"
+                                            f"Ссылка для участия: https://t.me/{self.bot_username}?start={payload}")
         keyboad = [[InlineKeyboardButton("Участвовать", callback_data=f"participate {lottery_id}")]]
-        photo_id = await self.firebase_db.read(f"lotteries/{lottery_id}/photo_id")
+        photo_id = lottery.get("photo_id")
         if photo_id:
             await context.bot.send_photo(
                 chat_id=chat_id,
@@ -395,7 +488,9 @@ class Lottery:
                 parse_mode="HTML",
                 reply_markup=InlineKeyboardMarkup(keyboad)
             )
+        return True
 
+    @timed_handler
     async def participate_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.info(f"participating button clicked by: {update.effective_user.username}")
         user = update.effective_user
@@ -403,28 +498,47 @@ class Lottery:
         match = re.match(r"^participate (\w+)$", query.data)
         lottery_id = match.group(1) if match else None
         if lottery_id:
-            lottery = await self.firebase_db.read(f"lotteries/{lottery_id}")
+            lottery = await self.storage.get_lottery(lottery_id)
             if lottery:
-                for ch in lottery["linked_channels"]:
-                    try:
-                        participant = await context.bot.get_chat_member(ch, user.id)
-                        match participant.status:
-                            case ChatMemberStatus.LEFT | ChatMemberStatus.BANNED:
-                                await query.answer("Вы не подписаны на все каналы, "
-                                                   "подписка на которые обязательна для участия в розыгрыше")
-                                return
-                    except TelegramError as e:
-                        print(e)
-                        await query.answer("Розыгрыша не было или он завершён")
-                        return
-                await self.firebase_db.update(f"lotteries/{lottery_id}/participants/",
-                                              {update.effective_user.id: update.effective_user.username})
+                # Repeat taps are answered from memory, without checking subscriptions again
+                if await self.participants.contains(lottery_id, user.id):
+                    await query.answer("Вы уже участвуете в розыгрыше!")
+                    return
+                try:
+                    subscribed = await self.membership.check(context.bot, lottery.get("linked_channels", []), user.id)
+                except TelegramError as e:
+                    logger.warning(f"can't check subscriptions for lottery {lottery_id}: {e}")
+                    await query.answer("Розыгрыша не было или он завершён")
+                    return
+                if not subscribed:
+                    await query.answer("Вы не подписаны на все каналы, "
+                                       "подписка на которые обязательна для участия в розыгрыше")
+                    return
+                try:
+                    members = await self.storage.add_participant(lottery_id, user.id, user.username)
+                except LotteryNotFound:
+                    await query.answer("Розыгрыша не было или он завершён")
+                    return
+                except Exception as e:
+                    logger.error(f"can't add participant {user.id} to lottery {lottery_id}: {e}")
+                    await query.answer("Не удалось записаться в розыгрыш, попробуйте ещё раз")
+                    return
+                self.participants.add(lottery_id, user.id)
+                if members is None:
+                    await query.answer("Вы уже участвуете в розыгрыше!")
+                    return
+                self.join_stats.record(lottery_id)
+                # Only this join sees the goal, the draw is started before any Bot API call can fail
+                await self.randomise_job.check_lottery_goal(context, lottery_id, lottery, members)
                 await query.answer("Вы участвуете в розыгрыше!")
-                await self.update_participate_button(update, lottery_id)
+                await self.update_participate_button(update, lottery_id, members)
+                return
             await query.answer("Розыгрыша не было или он завершён")
+            return
         await query.answer("Розыгрыша не было или он завершён")
 
-    async def update_participate_button(self, update: Update, lottery_id: str) -> None:
-        members = len((await self.firebase_db.read(f"lotteries/{lottery_id}/participants")).keys())
-        keyboard = [[InlineKeyboardButton(text=f"Участвовать ({members})", callback_data=f"participate {lottery_id}")]]
-        await update.callback_query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
+    async def update_participate_button(self, update: Update, lottery_id: str, members: int | None = None) -> None:
+        if members is None:
+            members = await self.storage.get_participant_count(lottery_id)
+        message = update.callback_query.message
+        self.button_updater.schedule(update.get_bot(), message.chat_id, message.message_id, lottery_id, members)
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+
+from telegram.ext import Application, ContextTypes
+
+from bot.workers import current_worker, worker_of
+from services.archive import Archive
+from services.lease import LeaseManager
+from services.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class Maintenance:
+    """
+    Repeating job keeping the live data small:
+    - finished lotteries queued in finished/{lottery_id} by Randomiser are moved to the local
+      archive together with their hourly join counts, by one worker at a time, once they
+      finished more than archive_delay seconds ago, their released draw leases are removed with them;
+    - drafts of lotteries started more than draft_ttl seconds ago are removed from user_data.
+    Every run handles at most batch_size lotteries and batch_size drafts.
+    """
+
+    def __init__(self, storage: Storage, archive: Archive, leases: LeaseManager, draft_ttl: float = 7 * 24 * 3600,
+                 batch_size: int = 500, interval: float = 600, archive_delay: float = 60) -> None:
+        """
+        archive_delay: Time in seconds join counts of a finished lottery may still be flushed by JoinStats.
+        """
+        self.storage = storage
+        self.archive = archive
+        self.leases = leases
+        self.draft_ttl = draft_ttl
+        self.archive_delay = archive_delay
+        self.batch_size = batch_size
+        self.interval = interval
+
+    async def run(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Drafts are local to the worker, they are swept whatever happens to the archiving
+        swept = self.sweep_drafts(context.application)
+        if swept:
+            logger.info(f"removed {swept} abandoned drafts")
+        try:
+            async with self.leases.hold("maintenance") as owned:
+                if owned:
+                    archived = await self.archive_finished()
+                    if archived:
+                        logger.info(f"archived {archived} lotteries")
+        except Exception as e:
+            logger.warning(f"can't archive finished lotteries: {e}")
+
+    async def archive_finished(self) -> int:
+        page = await self.storage.read_page("finished", limit=self.batch_size)
+        # Workers flush the join counts of the last joins after a delay, stats/ of a lottery
+        # is removed only after that, so late flushes don't leave orphan buckets
+        deadline = time.time() - self.archive_delay
+        finished = {lottery_id: lottery for lottery_id, lottery in page.items()
+                    if lottery.get("finished", 0) < deadline}
+        if not finished:
+            return 0
+        # The hourly join counts go to the archive with the lottery, the minute ones are dropped
+        hours = await self.storage.read_many([f"stats/{lottery_id}/hour" for lottery_id in finished])
+        for lottery, joins_by_hour in zip(finished.values(), hours):
+            lottery["joins_by_hour"] = joins_by_hour or {}
+        # Written to the archive before removal: a crash in between archives them twice,
+        # the later copy wins on lookup
+        await asyncio.to_thread(self.archive.append, finished)
+        removed = {}
+        for lottery_id in finished:
+            removed[f"finished/{lottery_id}"] = None
+            removed[f"stats/{lottery_id}"] = None
+            removed[f"leases/draw_{lottery_id}"] = None
+        await self.storage.update_many(removed)
+        return len(finished)
+
+    async def get_archived(self, lottery_id: str) -> dict | None:
+        return await asyncio.to_thread(self.archive.get, lottery_id)
+
+    def sweep_drafts(self, application: Application) -> int:
+        now = time.time()
+        stale = []
+        stamped = []
+        for user_id, user_data in application.user_data.items():
+            draft = user_data.get("draft")
+            # Drafts of other workers' users are swept by their own worker
+            if draft is None or worker_of(user_id) != current_worker():
+                continue
+            # Drafts started before they were stamped get their TTL from now on
+            if "created" not in draft:
+                draft["created"] = int(now)
+                stamped.append(user_id)
+            if draft["created"] < now - self.draft_ttl:
+                stale.append(user_id)
+                if len(stale) == self.batch_size:
+                    break
+        for user_id in stale:
+            application.user_data[user_id].pop("draft", None)
+        if stale or stamped:
+            application.mark_data_for_update_persistence(user_ids=stale + stamped)
+        return len(stale)
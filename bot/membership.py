@@ -0,0 +1,38 @@
+import asyncio
+
+from telegram import Bot
+from telegram.constants import ChatMemberStatus
+
+from services.cache import TTLCache
+
+
+class MembershipChecker:
+    """
+    Checks that a user is subscribed to a set of chats. All chats are queried
+    concurrently (at most max_concurrency get_chat_member calls at once) and the
+    results are cached per (chat_id, user_id), negative ones for a shorter time.
+    """
+
+    def __init__(self, max_concurrency: int = 10, positive_ttl: float = 60, negative_ttl: float = 5,
+                 maxsize: int = 100_000) -> None:
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(maxsize, positive_ttl)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def is_member(self, bot: Bot, chat_id: int, user_id: int) -> bool:
+        """
+        Raises TelegramError if the chat is not accessible for the bot.
+        """
+        cached = self._cache.get((chat_id, user_id))
+        if cached is not None:
+            return cached
+        async with self._semaphore:
+            member = await bot.get_chat_member(chat_id, user_id)
+        subscribed = member.status not in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED)
+        self._cache.set((chat_id, user_id), subscribed, self.positive_ttl if subscribed else self.negative_ttl)
+        return subscribed
+
+    async def check(self, bot: Bot, chat_ids: list[int], user_id: int) -> bool:
+        results = await asyncio.gather(*(self.is_member(bot, chat_id, user_id) for chat_id in chat_ids))
+        return all(results)
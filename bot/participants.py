@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import sys
+from collections import OrderedDict
+
+from services.bloom import BloomFilter
+from services.metrics import metrics
+from services.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+DEDUP_CHECKS = metrics.counter("participant_dedup_total", "Repeat join checks by the in-process participant index")
+
+
+class _LotteryParticipants:
+    __slots__ = ("exact", "bloom", "warmed", "task")
+
+    def __init__(self) -> None:
+        self.exact: set[int] | None = set()
+        self.bloom: BloomFilter | None = None
+        self.warmed = False
+        self.task: asyncio.Task | None = None
+
+    def nbytes(self) -> int:
+        if self.exact is None:
+            return self.bloom.nbytes
+        # Telegram user ids are 32 byte ints
+        return sys.getsizeof(self.exact) + 32 * len(self.exact)
+
+
+class ParticipantIndex:
+    """
+    Participants of recently active lotteries kept in memory, so repeat joins are answered
+    without requests. A lottery's set is loaded from storage in the background on its first
+    use and updated on every join. Up to exact_limit participants are kept as an exact set,
+    bigger lotteries switch to a Bloom filter whose hits are confirmed with a storage read.
+    The least recently used lotteries are dropped once there are more than max_lotteries
+    or they take more than max_bytes together.
+    """
+
+    def __init__(self, storage: Storage, max_lotteries: int = 1000, exact_limit: int = 100_000,
+                 bloom_capacity: int = 1_000_000, error_rate: float = 0.001, max_bytes: int = 64 * 2 ** 20) -> None:
+        self.storage = storage
+        self.max_lotteries = max_lotteries
+        self.max_bytes = max_bytes
+        self.exact_limit = exact_limit
+        self.bloom_capacity = bloom_capacity
+        self.error_rate = error_rate
+        self._lotteries: OrderedDict[str, _LotteryParticipants] = OrderedDict()
+        # Sum of nbytes() of the kept lotteries, updated on every change
+        self._nbytes = 0
+        metrics.gauge("participant_index_bytes", "Memory used by the participant index per lottery",
+                      lambda: [({"lottery_id": lottery_id}, nbytes) for lottery_id, nbytes in self.memory_usage().items()])
+
+    def memory_usage(self) -> dict[str, int]:
+        return {lottery_id: participants.nbytes() for lottery_id, participants in self._lotteries.items()}
+
+    def _get(self, lottery_id: str) -> _LotteryParticipants:
+        participants = self._lotteries.get(lottery_id)
+        if participants is None:
+            participants = self._lotteries[lottery_id] = _LotteryParticipants()
+            participants.task = asyncio.create_task(self._warm(lottery_id, participants))
+            self._nbytes += participants.nbytes()
+        self._lotteries.move_to_end(lottery_id)
+        self._shrink(lottery_id)
+        return participants
+
+    def _shrink(self, keep: str) -> None:
+        """
+        Drops the least recently used lotteries other than keep while over the limits.
+        """
+        while len(self._lotteries) > self.max_lotteries or self._nbytes > self.max_bytes:
+            lottery_id = next((lottery_id for lottery_id in self._lotteries if lottery_id != keep), None)
+            if lottery_id is None:
+                return
+            evicted = self._lotteries.pop(lottery_id)
+            self._nbytes -= evicted.nbytes()
+            evicted.task.cancel()
+
+    async def _warm(self, lottery_id: str, participants: _LotteryParticipants) -> None:
+        try:
+            async for user_id, _ in self.storage.iter_participants(lottery_id):
+                self._add(lottery_id, participants, int(user_id))
+        except Exception as e:
+            logger.warning(f"can't load participants of lottery {lottery_id}: {e}")
+            if self._lotteries.get(lottery_id) is participants:
+                del self._lotteries[lottery_id]
+                self._nbytes -= participants.nbytes()
+            return
+        participants.warmed = True
+
+    def _add(self, lottery_id: str, participants: _LotteryParticipants, user_id: int) -> None:
+        if participants.exact is None:
+            participants.bloom.add(user_id)
+            return
+        before = participants.nbytes()
+        participants.exact.add(user_id)
+        if len(participants.exact) > self.exact_limit:
+            participants.bloom = BloomFilter(max(self.bloom_capacity, 2 * self.exact_limit), self.error_rate)
+            for member in participants.exact:
+                participants.bloom.add(member)
+            participants.exact = None
+        # Participants of a dropped lottery still being loaded are not counted
+        if self._lotteries.get(lottery_id) is participants:
+            self._nbytes += participants.nbytes() - before
+            self._shrink(lottery_id)
+
+    def add(self, lottery_id: str, user_id: int) -> None:
+        self._add(lottery_id, self._get(lottery_id), user_id)
+
+    async def contains(self, lottery_id: str, user_id: int) -> bool:
+        """
+        True if the user participates in the lottery, False if not or if it's not known yet.
+        """
+        participants = self._get(lottery_id)
+        if participants.exact is not None:
+            found = user_id in participants.exact
+            DEDUP_CHECKS.inc(result="hit" if found else "miss")
+            return found
+        if user_id not in participants.bloom:
+            DEDUP_CHECKS.inc(result="miss")
+            return False
+        # A Bloom filter hit may be false, it is checked against storage
+        found = await self.storage.has_participant(lottery_id, user_id)
+        DEDUP_CHECKS.inc(result="hit" if found else "false_positive")
+        return found
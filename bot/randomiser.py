@@ -1,45 +1,101 @@
+import logging
 import time
-import random
 
+from telegram import Bot
 from telegram.ext import ContextTypes
-from services.firebase import FirebaseClient
+from services.draw import draw_winners
+from services.storage import Storage
+from services.lease import LeaseManager
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DRAW_JOB_LAG = metrics.histogram("draw_job_lag_seconds", "Delay between the due time of a draw and its job run")
+DRAW_SECONDS = metrics.histogram("draw_seconds", "Time spent drawing winners and announcing them")
 
 
 class Randomiser:
-    def __init__(self, firebase: FirebaseClient):
-        self.firebase_db = firebase
+    def __init__(self, storage: Storage, leases: LeaseManager):
+        self.storage = storage
+        self.leases = leases
+        self._finishing: set[str] = set()
 
     async def date_result(self, context: ContextTypes.DEFAULT_TYPE):
         data = context.job.data
-        owner_id, lottery_id = data["owner_id"], data["lottery_id"]
-        await self.get_result(context)
-        await self.firebase_db.delete(f"lotteries/{lottery_id}")
+        DRAW_JOB_LAG.observe(max(time.time() - data["until_ts"], 0))
+        await self.finish_lottery(context.bot, data["lottery_id"], data["until_ts"])
 
-    async def check_lottery_count(self, context: ContextTypes.DEFAULT_TYPE) -> None:
-        data = context.job.data
-        owner_id, lottery_id = data["owner_id"], data["lottery_id"]
-        goal_participants = data["goal_participants"]
+    async def check_lottery_goal(self, context: ContextTypes.DEFAULT_TYPE, lottery_id: str,
+                                 lottery: dict, participant_count: int) -> None:
+        """
+        Called on every successful join: starts the draw of a count-mode lottery
+        when participant_count reaches its max_count. The counter is incremented
+        atomically, so exactly one join sees the goal.
+        """
+        max_count = lottery.get("max_count")
+        if max_count and participant_count == max_count:
+            # The draw is put into the schedule index too, so another worker
+            # takes it over if this one dies before it's done
+            due_ts = int(time.time())
+            await self.storage.write(f"schedule/{due_ts}/{lottery_id}", True)
+            context.application.create_task(self.finish_lottery(context.bot, lottery_id, due_ts))
 
-        participants = await self.firebase_db.read(
-            f"lotteries/{lottery_id}/participants") or []
+    async def finish_lottery(self, bot: Bot, lottery_id: str, due_ts: int) -> None:
+        """
+        Runs the draw due at due_ts unless it's already done. Workers compete for
+        the draw lease, so only one of them runs it at a time.
+        """
+        if lottery_id in self._finishing:
+            return
+        self._finishing.add(lottery_id)
+        try:
+            async with self.leases.hold(f"draw_{lottery_id}") as owned:
+                if not owned:
+                    return
+                # The schedule entry is removed together with the lottery once it's drawn
+                if not await self.storage.read(f"schedule/{due_ts}/{lottery_id}"):
+                    return
+                lottery = await self.storage.get_lottery(lottery_id)
+                with DRAW_SECONDS.time():
+                    result = await self.get_result(lottery_id, lottery)
+                    # Firebase drops empty lists, a draw without participants has no winners key
+                    await self.announce(bot, lottery.get("publisher_chat_id"), result.get("winners", []))
+                # The lottery leaves the live tree at once, its result is queued
+                # in finished/ to be moved to the archive by Maintenance
+                await self.storage.update_many({
+                    f"lotteries/{lottery_id}": None,
+                    f"schedule/{due_ts}/{lottery_id}": None,
+                    f"draws/{lottery_id}": None,
+                    f"finished/{lottery_id}": lottery | result | {"finished": int(time.time())},
+                })
+        finally:
+            self._finishing.discard(lottery_id)
 
-        if len(participants) >= goal_participants:
-            await self.get_result(context)
-            context.job.schedule_removal()
-            await self.firebase_db.delete(f"lotteries/{lottery_id}")
+    async def get_result(self, lottery_id: str, lottery: dict) -> dict:
+        """
+        Draws the winners and stores them in draws/{lottery_id} before they are announced.
+        A retry after a failed announcement or a lost lease gets the stored result,
+        so the winners are never drawn twice.
+        """
+        result = await self.storage.read(f"draws/{lottery_id}")
+        if result:
+            return result
+        participant_count = await self.storage.get_participant_count(lottery_id)
+        winners, seed = await draw_winners(self.storage.iter_participants(lottery_id), lottery.get("num_winners", 0))
+        logger.info(f"lottery {lottery_id} drawn with seed {seed}")
+        drawn = {
+            "participant_count": participant_count,
+            "winners": [[int(user_id), username] for user_id, username in winners],
+            "seed": str(seed),
+        }
+        # A worker that lost the lease in the middle of its draw can't replace a stored result
+        return await self.storage.transaction(f"draws/{lottery_id}", lambda current: current or drawn)
 
-    async def get_result(self, context: ContextTypes.DEFAULT_TYPE) -> None:
-        data = context.job.data
-        owner_id, lottery_id = data["owner_id"], data["lottery_id"]
-        publisher_chat_id = data["publisher_chat_id"]
-        participants = await self.firebase_db.read(f"lotteries/{lottery_id}/participants")
-        if not participants:
-            await context.bot.send_message(chat_id=publisher_chat_id, text="No one participated")
+    @staticmethod
+    async def announce(bot: Bot, publisher_chat_id: int, winners: list[list]) -> None:
+        if not winners:
+            await bot.send_message(chat_id=publisher_chat_id, text="No one participated")
             return
-
-        num_winners = data["num_winners"]
-        random.seed(time.time())
-        winners = random.choices(participants, k=num_winners) if num_winners < len(participants) else participants
-        await context.bot.send_message(chat_id=publisher_chat_id,
-                                       text=f"Победители розыгрыша:\n"
-                                            f"{'\n'.join([f'@{winner}' for winner in winners.values()])}")
\ No newline at end of file
+        await bot.send_message(chat_id=publisher_chat_id,
+                               text=f"Победители розыгрыша:\n"
+                                    f"{'\n'.join(f'@{username or user_id}' for user_id, username in winners)}")
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from services.metrics import metrics
+from services.rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+BOT_API_SECONDS = metrics.histogram("bot_api_seconds", "Time spent in Bot API requests, without rate limiting")
+BOT_API_ERRORS = metrics.counter("bot_api_errors_total", "Failed Bot API requests")
+RATE_LIMIT_WAIT = metrics.histogram("rate_limiter_wait_seconds", "Time Bot API requests wait in the rate limiter queue")
+
+_PRIORITIES = ("high", "normal", "low")
+
+
+class _Waiter:
+    __slots__ = ("chat_id", "future", "enqueued")
+
+    def __init__(self, chat_id: int | str | None, future: asyncio.Future) -> None:
+        self.chat_id = chat_id
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """
+    Outbound flow control for all Bot API calls: sending methods wait in a priority queue
+    until both the global bucket and the bucket of their chat have a token.
+    Replies in private chats go first, messages to channels and groups next, message edits last.
+    Callback answers and reads are not subject to the message limits and never wait in the queue.
+    On RetryAfter sending to the chat which got it is paused for the given time, all sending
+    if the request had no chat, and the request is retried up to max_retries times.
+    """
+    HIGH, NORMAL, LOW = 0, 1, 2
+
+    def __init__(self, overall_rate: float = 30, private_rate: float = 1, group_rate: float = 20 / 60,
+                 burst: float = 3, max_retries: int = 2) -> None:
+        self.overall_rate = overall_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(overall_rate, overall_rate)
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._queues: list[deque[_Waiter]] = [deque(), deque(), deque()]
+        self._paused_until = 0.0
+        self._chats_paused_until: dict[int | str, float] = {}
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+        metrics.gauge("rate_limiter_queue_depth", "Bot API requests waiting in the rate limiter queue",
+                      lambda: [({"priority": name}, len(queue)) for name, queue in zip(_PRIORITIES, self._queues)])
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues)
+
+    async def initialize(self) -> None:
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def _priority(self, endpoint: str, chat_id: int | str | None) -> int | None:
+        if endpoint.startswith("edit"):
+            return self.LOW
+        if endpoint.startswith(("send", "copy", "forward")):
+            private = isinstance(chat_id, int) and chat_id > 0
+            return self.HIGH if private else self.NORMAL
+        # Callback answers and reads like getChatMember are not subject to the message limits
+        return None
+
+    def _chat_bucket(self, chat_id: int | str | None, now: float) -> TokenBucket | None:
+        if chat_id is None:
+            return None
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 1024:
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_full(now)}
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(self.private_rate if private else self.group_rate, self.burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _grant(self) -> float | None:
+        """
+        Lets through all waiters which may run now. Returns seconds until the next
+        waiter may run or None if the queue is empty.
+        """
+        now = time.monotonic()
+        if not self.queue_depth:
+            return None
+        if now < self._paused_until:
+            return self._paused_until - now
+        next_delay = None
+        for name, queue in zip(_PRIORITIES, self._queues):
+            for _ in range(len(queue)):
+                waiter = queue.popleft()
+                if waiter.future.done():
+                    continue
+                paused = self._chats_paused_until.get(waiter.chat_id, 0) - now
+                if paused > 0:
+                    queue.append(waiter)
+                    next_delay = paused if next_delay is None else min(next_delay, paused)
+                    continue
+                global_delay = self._global.delay(now)
+                if global_delay > 0:
+                    queue.appendleft(waiter)
+                    return global_delay
+                bucket = self._chat_bucket(waiter.chat_id, now)
+                chat_delay = bucket.delay(now) if bucket else 0
+                if chat_delay > 0:
+                    queue.append(waiter)
+                    next_delay = chat_delay if next_delay is None else min(next_delay, chat_delay)
+                    continue
+                self._global.consume(now)
+                if bucket:
+                    bucket.consume(now)
+                RATE_LIMIT_WAIT.observe(now - waiter.enqueued, priority=name)
+                waiter.future.set_result(None)
+        return next_delay
+
+    def _pause(self, chat_id: int | str | None, until: float) -> None:
+        if chat_id is None:
+            self._paused_until = max(self._paused_until, until)
+            return
+        now = time.monotonic()
+        self._chats_paused_until = {chat: paused for chat, paused in self._chats_paused_until.items() if paused > now}
+        self._chats_paused_until[chat_id] = max(self._chats_paused_until.get(chat_id, 0), until)
+        self._wakeup.set()
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            delay = self._grant()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except TimeoutError:
+                pass
+
+    async def _acquire(self, priority: int, chat_id: int | str | None) -> None:
+        if self._dispatcher is None:
+            await self.initialize()
+        waiter = _Waiter(chat_id, asyncio.get_running_loop().create_future())
+        self._queues[priority].append(waiter)
+        self._wakeup.set()
+        await waiter.future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        priority = self._priority(endpoint, chat_id)
+        for attempt in range(max_retries + 1):
+            if priority is not None:
+                await self._acquire(priority, chat_id)
+            try:
+                with BOT_API_SECONDS.time(endpoint=endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                BOT_API_ERRORS.inc(endpoint=endpoint, error="RetryAfter")
+                if attempt == max_retries:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.info(f"flood wait {retry_after}s on {endpoint}")
+                self._pause(chat_id, time.monotonic() + retry_after)
+                if priority is None:
+                    await asyncio.sleep(retry_after)
+            except Exception as e:
+                BOT_API_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+                raise
+        return None
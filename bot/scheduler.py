@@ -0,0 +1,59 @@
+import time
+from datetime import datetime
+
+from telegram.ext import ContextTypes, JobQueue
+
+from bot.randomiser import Randomiser
+from services.storage import Storage
+
+
+class DrawScheduler:
+    """
+    Keeps pending draws in a schedule/{until_ts}/{lottery_id} index ordered by due time,
+    so they survive restarts. Only draws due within the next horizon seconds are loaded
+    into the job queue. The index is rescanned every interval seconds, which also retries
+    overdue draws left by a dead worker once their lease expires.
+    """
+
+    def __init__(self, storage: Storage, randomiser: Randomiser, horizon: int = 3600,
+                 interval: int = 60) -> None:
+        self.storage = storage
+        self.randomiser = randomiser
+        self.horizon = horizon
+        self.interval = interval
+        self._loaded_until: int | None = None
+
+    @staticmethod
+    def index_entry(lottery_id: str, until: datetime) -> dict:
+        """
+        Schedule index entry of the draw, to be committed together with the lottery.
+        """
+        return {f"schedule/{int(until.timestamp())}/{lottery_id}": True}
+
+    def add_draw(self, job_queue: JobQueue, lottery_id: str, until: datetime) -> None:
+        until_ts = int(until.timestamp())
+        if self._loaded_until is not None and until_ts <= self._loaded_until:
+            self._add_job(job_queue, lottery_id, until_ts)
+
+    async def load_due(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Repeating job: adds jobs for draws due before now + horizon, including the overdue
+        ones, e.g. which became overdue while the bot was down.
+        """
+        end = int(time.time()) + self.horizon
+        due = await self.storage.read_range("schedule", end=end)
+        self._loaded_until = end
+        for until_ts, lottery_ids in due.items():
+            for lottery_id in lottery_ids:
+                self._add_job(context.job_queue, lottery_id, int(until_ts))
+
+    def _add_job(self, job_queue: JobQueue, lottery_id: str, until_ts: int) -> None:
+        name = f"draw {lottery_id}"
+        if job_queue.get_jobs_by_name(name):
+            return
+        # run_once skips jobs whose time has passed long ago, overdue draws run right away.
+        # Draws are never dropped as misfired when the event loop is busy at their due time.
+        when = max(until_ts - time.time(), 0)
+        job_queue.run_once(self.randomiser.date_result, when=when, name=name,
+                           data={"lottery_id": lottery_id, "until_ts": until_ts},
+                           job_kwargs={"misfire_grace_time": None})
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from telegram.ext import ContextTypes
+
+from services.metrics import metrics
+from services.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+HOUR = 3600
+DAY = 24 * HOUR
+
+STATS_FLUSHED = metrics.counter("join_stats_flushed_total", "Join counts added to the stats buckets")
+
+
+class JoinStats:
+    """
+    Joins of every lottery counted by minute and by hour in stats/{lottery_id}/{minute|hour}/{bucket_ts}.
+    Joins are summed in memory and added to the buckets every interval seconds, so a busy lottery
+    costs one transaction per touched bucket instead of one per join. Joins counted since the last
+    flush are lost if the worker dies.
+    """
+
+    def __init__(self, storage: Storage, interval: float = 10) -> None:
+        self.storage = storage
+        self.interval = interval
+        self._pending: dict[tuple[str, str, int], int] = {}
+
+    def record(self, lottery_id: str, now: float | None = None) -> None:
+        now = time.time() if now is None else now
+        for kind, size in (("minute", MINUTE), ("hour", HOUR)):
+            key = (lottery_id, kind, int(now // size * size))
+            self._pending[key] = self._pending.get(key, 0) + 1
+
+    async def flush(self, context: ContextTypes.DEFAULT_TYPE | None = None) -> None:
+        pending, self._pending = self._pending, {}
+
+        async def add(key: tuple[str, str, int], count: int) -> None:
+            lottery_id, kind, bucket = key
+            try:
+                await self.storage.transaction(f"stats/{lottery_id}/{kind}/{bucket}",
+                                               lambda value: (value or 0) + count)
+                STATS_FLUSHED.inc(count)
+            except Exception as e:
+                # Kept for the next flush
+                logger.warning(f"can't update join stats of lottery {lottery_id}: {e}")
+                self._pending[key] = self._pending.get(key, 0) + count
+
+        await asyncio.gather(*(add(key, count) for key, count in pending.items()))
+
+    async def get(self, lottery_id: str, now: float | None = None) -> tuple[dict[int, int], dict[int, int]]:
+        """
+        Returns the joins of the last hour by minute and all the joins by hour as {bucket_ts: count},
+        including the ones not flushed yet.
+        """
+        now = time.time() if now is None else now
+        minutes, hours = await asyncio.gather(
+            self.storage.read_range(f"stats/{lottery_id}/minute", start=int(now // MINUTE * MINUTE) - HOUR + MINUTE),
+            self.storage.read(f"stats/{lottery_id}/hour"),
+        )
+        by_kind = {
+            "minute": {int(bucket): count for bucket, count in (minutes or {}).items()},
+            "hour": {int(bucket): count for bucket, count in (hours or {}).items()},
+        }
+        for (pending_id, kind, bucket), count in self._pending.items():
+            if pending_id == lottery_id:
+                by_kind[kind][bucket] = by_kind[kind].get(bucket, 0) + count
+        return by_kind["minute"], by_kind["hour"]
+
+
+def render_stats(lottery_id: str, participant_count: int, minutes: dict[int, int], hours: dict[int, int],
+                 now: float | None = None, last_hours: int = 24) -> str:
+    """
+    Formats the totals and the hourly growth of a lottery, the last last_hours hours are listed.
+    """
+    now = time.time() if now is None else now
+    lines = [
+        f"Статистика розыгрыша {lottery_id}",
+        f"Участников: {participant_count}",
+        f"За последний час: {sum(count for bucket, count in minutes.items() if bucket > now - HOUR)}",
+        f"За последние 24 часа: {sum(count for bucket, count in hours.items() if bucket > now - DAY)}",
+    ]
+    if hours:
+        peak = max(hours, key=hours.get)
+        lines.append(f"Лучший час: {_format_hour(peak)} — {hours[peak]}")
+        lines.append("")
+        lines.append("По часам (МСК):")
+        buckets = sorted(hours)
+        total = sum(hours[bucket] for bucket in buckets[:-last_hours])
+        for bucket in buckets[-last_hours:]:
+            total += hours[bucket]
+            lines.append(f"{_format_hour(bucket)} +{hours[bucket]} (всего {total})")
+    return "\n".join(lines)
+
+
+def _format_hour(bucket: int) -> str:
+    return datetime.fromtimestamp(bucket, ZoneInfo("Europe/Moscow")).strftime("%d.%m %H:00")
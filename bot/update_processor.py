@@ -0,0 +1,64 @@
+import asyncio
+from collections.abc import Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from bot.admission import ADMITTED, AdmissionControl
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to max_concurrent_updates updates at once, while updates of the same user
+    are processed one after another in arrival order, so ConversationHandler states stay correct.
+    Updates waiting for an earlier update of their user don't take a slot.
+    With admission, updates are admitted or shed before they wait for anything.
+    """
+
+    def __init__(self, max_concurrent_updates: int, admission: AdmissionControl | None = None) -> None:
+        # Updates are shed only after they are taken in, so with admission
+        # more are taken in at once than it lets through
+        super().__init__(max_concurrent_updates if admission is None else 2 * admission.max_in_flight)
+        self.admission = admission
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._pending: dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        if self.admission is None:
+            await self._process(update, coroutine)
+            return
+        reason = self.admission.admit(update)
+        if reason != ADMITTED:
+            coroutine.close()
+            await self.admission.shed(update, reason)
+            return
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self.admission.release(update)
+
+    async def _process(self, update: object, coroutine: Awaitable) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        lock = self._locks.get(user.id)
+        if lock is None:
+            lock = self._locks[user.id] = asyncio.Lock()
+        self._pending[user.id] = self._pending.get(user.id, 0) + 1
+        try:
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            self._pending[user.id] -= 1
+            if not self._pending[user.id]:
+                del self._pending[user.id]
+                del self._locks[user.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+from collections.abc import Callable
+
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# Index of the worker running in this process, 0 in the main process
+_worker_index = 0
+# Update queues of all the workers, None without a WorkerPool
+_queues: list[multiprocessing.Queue] | None = None
+
+
+def current_worker() -> int:
+    return _worker_index
+
+
+def worker_of(user_id: int) -> int:
+    """
+    Index of the worker handling the updates and user_data of the user.
+    """
+    return user_id % len(_queues) if _queues else 0
+
+
+def send_to_worker(index: int, message: object) -> None:
+    """
+    Puts a picklable message into the update queue of another worker,
+    where it's processed like an update, e.g. by a TypeHandler.
+    """
+    _queues[index].put(message)
+
+
+def _run_worker(index: int, queues: list[multiprocessing.Queue],
+                build_app: Callable[[ApplicationBuilder], Application]) -> None:
+    global _worker_index, _queues
+    _worker_index = index
+    _queues = queues
+    # The receiver stops the workers with a sentinel once it has stopped itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    app = build_app(Application.builder().updater(None))
+    asyncio.run(_serve(index, app, queues[index]))
+
+
+async def _serve(index: int, app: Application, queue: multiprocessing.Queue) -> None:
+    loop = asyncio.get_running_loop()
+    # Applications only run their post_init/post_shutdown hooks in run_polling/run_webhook
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        logger.info(f"worker {index} started")
+        while (data := await loop.run_in_executor(None, queue.get)) is not None:
+            # Updates come as dicts, other objects are messages from other workers
+            await app.update_queue.put(Update.de_json(data, app.bot) if isinstance(data, dict) else data)
+        await app.stop()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+
+class WorkerPool:
+    """
+    Receives updates in this process and shares them between num_workers processes,
+    each running its own Application built by build_app. Updates are routed by user id,
+    so every user always lands on the same worker and its ConversationHandler states.
+    Draws are coordinated between workers through leases in the storage.
+    """
+
+    def __init__(self, num_workers: int, build_app: Callable[[ApplicationBuilder], Application]) -> None:
+        self.build_app = build_app
+        self.queues = [multiprocessing.Queue() for _ in range(num_workers)]
+        self.processes = [
+            multiprocessing.Process(target=_run_worker, args=(index, self.queues, build_app), name=f"worker-{index}")
+            for index in range(num_workers)
+        ]
+
+    async def forward(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        index = user.id % len(self.queues) if user else 0
+        self.queues[index].put(update.to_dict())
+
+    def receiver(self, builder: ApplicationBuilder) -> Application:
+        app = builder.build()
+        app.add_handler(TypeHandler(Update, self.forward))
+        return app
+
+    def start(self) -> None:
+        for process in self.processes:
+            process.start()
+
+    def stop(self) -> None:
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join()
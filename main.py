@@ -1,12 +1,18 @@
+from bot.admission import AdmissionControl
 from bot.bot import Bot
+from bot.rate_limiter import PriorityRateLimiter
+from bot.update_processor import PerUserUpdateProcessor
+from bot.workers import WorkerPool, current_worker, worker_of
 from dotenv import load_dotenv
 import os
 import logging
 
 from telegram import Update
-from telegram.ext import Application, DictPersistence
+from telegram.ext import Application, ApplicationBuilder
 
-from services.firebase import FirebaseClient
+from services.metrics import metrics
+from services.persistence import StoragePersistence
+from services.storage import Storage
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -17,12 +23,86 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
+def create_storage() -> Storage:
+    backend = os.getenv("STORAGE_BACKEND", "firebase")
+    if backend == "firebase":
+        from services.firebase import FirebaseClient
+        return FirebaseClient(
+            os.getenv("FIREBASE_URL"), os.getenv("FIREBASE_SECRET"),
+            pool_size=int(os.getenv("FIREBASE_POOL_SIZE", 10)),
+            timeout=float(os.getenv("FIREBASE_TIMEOUT", 10)),
+        )
+    if backend in ("sqlite", "memory"):
+        from services.sqlite_storage import SQLiteStorage
+        return SQLiteStorage(os.getenv("SQLITE_PATH", "lottery.db") if backend == "sqlite" else ":memory:")
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+def build_app(builder: ApplicationBuilder) -> Application:
+    storage = create_storage()
+
+    async def start_metrics(_: Application) -> None:
+        slow_call_threshold = os.getenv("SLOW_CALL_THRESHOLD")
+        if slow_call_threshold:
+            metrics.slow_call_threshold = float(slow_call_threshold)
+        port = os.getenv("METRICS_PORT")
+        if port:
+            # Every worker process serves its own metrics on the next port
+            await metrics.serve(os.getenv("METRICS_HOST", "127.0.0.1"), int(port) + current_worker())
+
+    async def close_storage(_: Application) -> None:
+        await metrics.stop()
+        storage.close()
+
+    admission = AdmissionControl(int(os.getenv("MAX_QUEUED_UPDATES", 1024)),
+                                 user_rate=float(os.getenv("USER_RATE", 2)),
+                                 user_burst=float(os.getenv("USER_BURST", 10)))
+    persistence = StoragePersistence(storage, update_interval=float(os.getenv("PERSISTENCE_INTERVAL", 60)),
+                                     owns_user=lambda user_id: worker_of(user_id) == current_worker())
+    app = (builder.token(os.getenv("TOKEN"))
+           .persistence(persistence)
+           .rate_limiter(PriorityRateLimiter())
+           .concurrent_updates(PerUserUpdateProcessor(int(os.getenv("MAX_CONCURRENT_UPDATES", 64)), admission))
+           .post_init(start_metrics)
+           .post_shutdown(close_storage)
+           .build())
+    Bot(app, storage, os.getenv("BOT_USERNAME"),
+        button_edit_window=float(os.getenv("BUTTON_EDIT_WINDOW", 3)),
+        lease_ttl=float(os.getenv("LEASE_TTL", 60)),
+        link_secret=os.getenv("LINK_SECRET"),
+        archive_dir=os.getenv("ARCHIVE_DIR", "archive"),
+        draft_ttl=float(os.getenv("DRAFT_TTL", 7 * 24 * 3600)))
+    return app
+
+
+def run(app: Application) -> None:
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        app.run_webhook(
+            listen=os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+            port=int(os.getenv("WEBHOOK_PORT", 8443)),
+            url_path=os.getenv("WEBHOOK_PATH", "telegram"),
+            webhook_url=webhook_url,
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
 def main() -> None:
     load_dotenv()
-    firebase = FirebaseClient(os.getenv("FIREBASE_URL"), os.getenv("FIREBASE_SECRET"))
-    app = Application.builder().token(os.getenv("TOKEN")).persistence(DictPersistence()).build()
-    Bot(app, firebase, os.getenv("BOT_USERNAME"))
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    workers = int(os.getenv("WORKERS", 1))
+    if workers <= 1:
+        run(build_app(Application.builder()))
+        return
+
+    pool = WorkerPool(workers, build_app)
+    pool.start()
+    try:
+        run(pool.receiver(Application.builder().token(os.getenv("TOKEN"))))
+    finally:
+        pool.stop()
 
 
 if __name__ == "__main__":
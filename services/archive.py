@@ -0,0 +1,87 @@
+import json
+import os
+import struct
+import zlib
+
+# id length, payload length
+_HEADER = struct.Struct(">HI")
+
+
+class Archive:
+    """
+    Append-only archive of records in segment files under directory, each record is
+    zlib compressed JSON stored after its id. Records are looked up by id through an index
+    built by scanning the segments, appends of other processes are picked up by rescanning.
+    A later record with the same id replaces an earlier one.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        # id: (segment, offset, length) of the record payload
+        self._index: dict[str, tuple[str, int, int]] = {}
+        # segment: bytes of it which were scanned
+        self._scanned: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        self._scan()
+        return len(self._index)
+
+    def _segments(self) -> list[str]:
+        return sorted(name for name in os.listdir(self.directory) if name.startswith("segment-"))
+
+    def _scan(self) -> None:
+        for name in self._segments():
+            path = os.path.join(self.directory, name)
+            size = os.path.getsize(path)
+            offset = self._scanned.get(name, 0)
+            if offset >= size:
+                continue
+            with open(path, "rb") as file:
+                file.seek(offset)
+                while offset + _HEADER.size <= size:
+                    id_length, length = _HEADER.unpack(file.read(_HEADER.size))
+                    end = offset + _HEADER.size + id_length + length
+                    # A record cut short by a crash ends the segment
+                    if end > size:
+                        break
+                    key = file.read(id_length).decode()
+                    self._index[key] = (name, end - length, length)
+                    file.seek(end)
+                    offset = end
+            self._scanned[name] = offset
+
+    def append(self, records: dict[str, object]) -> None:
+        """
+        Appends records {id: value} in one write.
+        """
+        self._scan()
+        segments = self._segments()
+        name = segments[-1] if segments else "segment-000000"
+        path = os.path.join(self.directory, name)
+        # An empty segment left by a crash has never been scanned, it's appended to
+        if segments and (os.path.getsize(path) >= self.segment_size or self._scanned.get(name, 0) < os.path.getsize(path)):
+            name = f"segment-{int(name.removeprefix('segment-')) + 1:06d}"
+            path = os.path.join(self.directory, name)
+        chunks = []
+        for key, value in records.items():
+            key = key.encode()
+            payload = zlib.compress(json.dumps(value, separators=(",", ":")).encode(), 9)
+            chunks += [_HEADER.pack(len(key), len(payload)), key, payload]
+        with open(path, "ab") as file:
+            file.write(b"".join(chunks))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def get(self, key: str) -> object | None:
+        entry = self._index.get(key)
+        if entry is None:
+            self._scan()
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+        name, offset, length = entry
+        with open(os.path.join(self.directory, name), "rb") as file:
+            file.seek(offset)
+            return json.loads(zlib.decompress(file.read(length)))
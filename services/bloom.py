@@ -0,0 +1,32 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Set of ints without false negatives, false positives happen with error_rate
+    probability while it holds at most capacity items.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001) -> None:
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: int):
+        digest = hashlib.blake2b(item.to_bytes(8, "big", signed=True), digest_size=16).digest()
+        # Double hashing: k positions from two independent 64-bit hashes
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        for i in range(self.num_hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, item: int) -> None:
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: int) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
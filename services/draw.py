@@ -0,0 +1,38 @@
+import math
+import random
+import secrets
+from typing import AsyncIterable, TypeVar
+
+T = TypeVar("T")
+
+
+def _uniform(rng: random.Random) -> float:
+    # Open interval (0, 1), log() of it is always defined
+    return rng.random() or 1e-300
+
+
+async def draw_winners(entries: AsyncIterable[T], k: int, seed: int | None = None) -> tuple[list[T], int]:
+    """
+    Picks k distinct entries uniformly at random in a single pass, keeping only k entries
+    in memory (reservoir sampling, Algorithm L). The PRNG is seeded from secrets unless
+    a seed is given, the seed is returned so the draw can be reproduced.
+    """
+    if seed is None:
+        seed = secrets.randbits(128)
+    rng = random.Random(seed)
+    reservoir: list[T] = []
+    if k <= 0:
+        return reservoir, seed
+
+    w = math.exp(math.log(_uniform(rng)) / k)
+    next_index = k + math.floor(math.log(_uniform(rng)) / math.log(1 - w))
+    index = 0
+    async for entry in entries:
+        if index < k:
+            reservoir.append(entry)
+        elif index == next_index:
+            reservoir[rng.randrange(k)] = entry
+            w *= math.exp(math.log(_uniform(rng)) / k)
+            next_index += math.floor(math.log(_uniform(rng)) / math.log(1 - w)) + 1
+        index += 1
+    return reservoir, seed
@@ -1,40 +1,85 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import firebase_admin
 from firebase_admin import credentials, db
 
+from services.storage import Storage
+
 
-class FirebaseClient:
-    def __init__(self, firebase_url: str, secret: str) -> None:
+class FirebaseClient(Storage):
+    def __init__(self, firebase_url: str, secret: str, pool_size: int = 10, timeout: float = 10.0,
+                 **kwargs) -> None:
         """
         firebase_url: Firebase Runtime DB URL.
         secret: Firebase Runtime DB secret.
+        pool_size: Max number of concurrent requests to Firebase.
+        timeout: HTTP timeout of a single request in seconds.
+        kwargs: Storage settings.
         """
+        super().__init__(**kwargs)
         cred = credentials.Certificate(secret)
-        firebase_admin.initialize_app(cred, {"databaseURL": firebase_url})
+        firebase_admin.initialize_app(cred, {"databaseURL": firebase_url, "httpTimeout": timeout})
         self.db = db
+        # The SDK is blocking, so every call runs in a bounded pool of threads
+        # sharing the SDK's keep-alive HTTP session instead of on the event loop.
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="firebase")
 
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
 
-    async def write(self, path: str, data: int|dict|str|object) -> None:
-        self.db.reference(path).set(data)
-
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
 
-    async def update(self, path: str, data: dict) -> None:
-        self.db.reference(path).update(data)
+    async def _write(self, path: str, data: object) -> None:
+        await self._run(self.db.reference(path).set, data)
 
+    async def _update(self, path: str, data: dict) -> None:
+        await self._run(self.db.reference(path).update, data)
 
-    async def read(self, path: str) -> object|str|int|dict|None:
-        return self.db.reference(path).get()
+    async def _read(self, path: str) -> object|str|int|dict|None:
+        return await self._run(self.db.reference(path).get)
 
+    async def _delete(self, path: str) -> None:
+        await self._run(self.db.reference(path).delete)
 
-    async def delete(self, path: str) -> None:
-        self.db.reference(path).delete()
+    async def _transaction(self, path: str, func) -> object:
+        return await self._run(self.db.reference(path).transaction, func)
 
+    async def _read_shallow(self, path: str) -> dict:
+        data = await self._run(self.db.reference(path).get, shallow=True)
+        return data if isinstance(data, dict) else {}
 
-    async def get_user_channels(self, user_id: int) -> list:
-        data = await self.read(f"users/{user_id}/channels")
-        return data if isinstance(data, list) else []
+    async def _read_range(self, path: str, start: str | None, end: str | None) -> dict:
+        query = self.db.reference(path).order_by_key()
+        if start is not None:
+            query = query.start_at(start)
+        if end is not None:
+            query = query.end_at(end)
+        return self._in_key_order(await self._run(query.get) or {})
 
-    async def set_user_channels(self, user_id: int, channels: list) -> None:
-        if isinstance(channels, list):
-            await self.write(f"users/{user_id}/channels", channels)
+    async def _read_page(self, path: str, start_after: str | None, limit: int) -> dict:
+        query = self.db.reference(path).order_by_key()
+        if start_after is None:
+            query = query.limit_to_first(limit)
         else:
-            raise TypeError("channels must be a list")
+            query = query.start_at(start_after).limit_to_first(limit + 1)
+        page = self._in_key_order(await self._run(query.get) or {})
+        return {key: value for key, value in page.items() if key != start_after}
+
+    @staticmethod
+    def _key_order(key: str) -> tuple:
+        # Keys which are 32-bit integers go first in numeric order, the rest as strings
+        try:
+            number = int(key)
+        except ValueError:
+            return 1, 0, key
+        if -2 ** 31 <= number < 2 ** 31 and str(number) == key:
+            return 0, number, ""
+        return 1, 0, key
+
+    def _in_key_order(self, data: dict) -> dict:
+        # The SDK sorts query results by key as strings, the server's order is restored
+        return dict(sorted(data.items(), key=lambda item: self._key_order(item[0])))
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from services.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class _LeaseHeld(Exception):
+    pass
+
+
+class LeaseManager:
+    """
+    Time-limited ownership records in leases/{name}: {"owner": ..., "expires": unix_ts}.
+    A lease is granted if it's free, expired or already owned by this worker, so the lease
+    of a dead worker is taken over once it expires. Released leases are kept expired,
+    the ones of finished draws are removed by Maintenance.
+    """
+
+    def __init__(self, storage: Storage, ttl: float = 60, owner: str | None = None) -> None:
+        self.storage = storage
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+
+    async def acquire(self, name: str, renew_only: bool = False) -> bool:
+        def take(lease):
+            now = time.time()
+            if lease and lease["owner"] != self.owner and (renew_only or lease["expires"] > now):
+                raise _LeaseHeld
+            if renew_only and not lease:
+                raise _LeaseHeld
+            return {"owner": self.owner, "expires": now + self.ttl}
+
+        try:
+            await self.storage.transaction(f"leases/{name}", take)
+        except _LeaseHeld:
+            return False
+        return True
+
+    async def renew(self, name: str) -> bool:
+        return await self.acquire(name, renew_only=True)
+
+    async def release(self, name: str) -> None:
+        def free(lease):
+            if not lease or lease["owner"] != self.owner:
+                raise _LeaseHeld
+            # Firebase transactions can't delete, an expired lease is as good as none
+            return {"owner": self.owner, "expires": 0}
+
+        try:
+            await self.storage.transaction(f"leases/{name}", free)
+        except _LeaseHeld:
+            pass
+
+    async def _keep_renewed(self, name: str, holder: asyncio.Task, lost: asyncio.Event) -> None:
+        expires = time.time() + self.ttl
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                renewed = await self.renew(name)
+            except Exception as e:
+                logger.warning(f"can't renew lease {name}: {e}")
+                renewed = None
+            if renewed:
+                expires = time.time() + self.ttl
+            elif renewed is False or time.time() > expires - self.ttl / 3:
+                # Another worker may take the lease over, the held block is stopped
+                logger.warning(f"lease {name} was lost by {self.owner}")
+                lost.set()
+                holder.cancel()
+                return
+
+    @asynccontextmanager
+    async def hold(self, name: str) -> AsyncIterator[bool]:
+        """
+        Acquires the lease and renews it in the background until the block exits.
+        Yields False without running anything if another worker owns the lease.
+        If the lease can't be renewed, the block is cancelled and exits without an error.
+        """
+        if not await self.acquire(name):
+            yield False
+            return
+        holder = asyncio.current_task()
+        lost = asyncio.Event()
+        renewer = asyncio.create_task(self._keep_renewed(name, holder, lost))
+        try:
+            yield True
+        except asyncio.CancelledError:
+            # Only the cancellation by the renewer is swallowed
+            if not lost.is_set() or holder.uncancel():
+                raise
+        finally:
+            renewer.cancel()
+            await self.release(name)
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    items = [f'{key}="{_escape(value)}"' for key, value in labels]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(labels)} {value}" for labels, value in self._values.items()]
+        return lines
+
+
+class _Series:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, size: int) -> None:
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._series: dict[tuple, _Series] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(len(self.buckets))
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the time spent in the block, logs it if it exceeds metrics.slow_call_threshold.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(elapsed, **labels)
+            threshold = metrics.slow_call_threshold
+            if threshold is not None and elapsed >= threshold:
+                logger.warning(f"slow call: {self.name}{_format_labels(tuple(sorted(labels.items())))} "
+                               f"took {elapsed:.3f}s")
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in self._series.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series.counts):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(labels, le)} {total}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {series.sum}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {total}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str, collect) -> None:
+        """
+        collect: Called on every render, returns (labels, value) pairs of the current values.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{_format_labels(tuple(sorted(labels.items())))} {value}"
+                  for labels, value in self.collect()]
+        return lines
+
+
+class Metrics:
+    """
+    Registry of the bot's counters and histograms, served in Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+        # Calls timed with Histogram.time() taking longer are logged, None disables the log
+        self.slow_call_threshold: float | None = None
+        self._server: asyncio.Server | None = None
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, documentation, buckets))
+
+    def gauge(self, name: str, documentation: str, collect) -> Gauge:
+        # Gauges read the state of an object, the latest registered one is reported
+        self._metrics[name] = Gauge(name, documentation, collect)
+        return self._metrics[name]
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+    async def serve(self, host: str, port: int) -> None:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"metrics are served on http://{host}:{port}/metrics")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # Every request gets the metrics, its path and headers are not looked at
+            while (await reader.readline()).strip():
+                pass
+            body = self.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+metrics = Metrics()
+
+HANDLER_SECONDS = metrics.histogram("handler_seconds", "Time spent in update handlers")
+HANDLER_ERRORS = metrics.counter("handler_errors_total", "Exceptions raised by update handlers")
+
+
+def timed_handler(func):
+    """
+    Records latency and exceptions of a handler under its function name.
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        with HANDLER_SECONDS.time(handler=func.__name__):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                HANDLER_ERRORS.inc(handler=func.__name__, error=type(e).__name__)
+                raise
+    return wrapper
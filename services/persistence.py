@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from collections.abc import Callable
+from copy import deepcopy
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from services.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class StoragePersistence(BasePersistence[dict, dict, dict]):
+    """
+    Keeps conversations, user_data, chat_data and bot_data under persistence/ in the storage.
+
+    Application calls update_* every update_interval seconds for the changed entries only,
+    they are collected as dirty paths and written with a single multi-path update
+    flush_delay seconds later. On startup only the data of active conversations is loaded.
+    """
+
+    def __init__(self, storage: Storage, update_interval: float = 60, flush_delay: float = 1.0,
+                 root: str = "persistence", owns_user: Callable[[int], bool] | None = None) -> None:
+        """
+        owns_user: Tells if user_data of the user belongs to this process, with several workers
+        each of them loads and writes only the user_data of its own users.
+        """
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.storage = storage
+        self.owns_user = owns_user
+        self.flush_delay = flush_delay
+        self.root = root
+        self._conversations: dict[str, dict[tuple[int, ...], object]] | None = None
+        self._bot_data: dict | None = None
+        self._dirty: dict[str, object] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    @staticmethod
+    def _encode_key(key: tuple[int, ...]) -> str:
+        return ",".join(str(part) for part in key)
+
+    @staticmethod
+    def _decode_key(key: str) -> tuple[int, ...]:
+        return tuple(int(part) for part in key.split(","))
+
+    async def _load_conversations(self) -> dict[str, dict[tuple[int, ...], object]]:
+        if self._conversations is None:
+            data = await self.storage.read(f"{self.root}/conversations") or {}
+            self._conversations = {
+                name: {self._decode_key(key): state for key, state in states.items()}
+                for name, states in data.items()
+            }
+        return self._conversations
+
+    async def _load_active(self, kind: str, key_part: int, owns: Callable[[int], bool] | None = None) -> dict[int, dict]:
+        conversations = await self._load_conversations()
+        ids = {key[key_part] for states in conversations.values() for key in states}
+        ids = sorted(i for i in ids if owns is None or owns(i))
+        data = await self.storage.read_many([f"{self.root}/{kind}/{i}" for i in ids])
+        return {i: value or {} for i, value in zip(ids, data)}
+
+    async def get_user_data(self) -> dict[int, dict]:
+        # Conversation keys are (chat_id, user_id)
+        return await self._load_active("user_data", -1, self.owns_user)
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return await self._load_active("chat_data", 0)
+
+    async def get_bot_data(self) -> dict:
+        if self._bot_data is None:
+            self._bot_data = await self.storage.read(f"{self.root}/bot_data") or {}
+        return deepcopy(self._bot_data)
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict[tuple[int, ...], object]:
+        return dict((await self._load_conversations()).get(name, {}))
+
+    def _mark_dirty(self, path: str, value: object) -> None:
+        self._dirty[f"{self.root}/{path}"] = value
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        self._flush_task = None
+        await self._write_dirty()
+
+    async def _write_dirty(self) -> None:
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            await self.storage.update_many(dirty)
+        except Exception:
+            logger.exception("can't flush persistence, retrying on next update")
+            self._dirty = dirty | self._dirty
+
+    async def update_conversation(self, name: str, key: tuple[int, ...], new_state: object | None) -> None:
+        conversations = (await self._load_conversations()).setdefault(name, {})
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._mark_dirty(f"conversations/{name}/{self._encode_key(key)}", new_state)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._mark_dirty(f"user_data/{user_id}", data or None)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._mark_dirty(f"chat_data/{chat_id}", data or None)
+
+    async def update_bot_data(self, data: dict) -> None:
+        # Application passes bot_data on every run, changed or not
+        if data == self._bot_data:
+            return
+        self._bot_data = deepcopy(data)
+        self._mark_dirty("bot_data", data or None)
+
+    async def update_callback_data(self, data: object) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._mark_dirty(f"chat_data/{chat_id}", None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._mark_dirty(f"user_data/{user_id}", None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write_dirty()
@@ -0,0 +1,35 @@
+import time
+
+
+class TokenBucket:
+    """
+    Allows rate events per second on average with bursts of up to capacity events.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float | None = None) -> float:
+        """
+        Seconds until a token is available, 0 if it is available now.
+        """
+        self._refill(time.monotonic() if now is None else now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float | None = None) -> bool:
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now: float | None = None) -> bool:
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= self.capacity
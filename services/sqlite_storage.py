@@ -0,0 +1,249 @@
+import asyncio
+import json
+import sqlite3
+from collections.abc import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from services.storage import LotteryNotFound, Storage
+
+# Paths are stored with SEP between keys, so a subtree of "a" is the key range ("a" SEP, "a" END)
+SEP = "\x01"
+END = "\x02"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (path TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS participants (
+    lottery_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    PRIMARY KEY (lottery_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS participants_user_id ON participants (user_id);
+"""
+
+
+def _key(path: str) -> str:
+    return SEP.join(part for part in path.split("/") if part)
+
+
+def _child(key: str, child: str) -> str:
+    return f"{key}{SEP}{child}" if key else child
+
+
+def _flatten(key: str, value: object, rows: list) -> list[tuple[str, str]]:
+    if isinstance(value, list):
+        value = {str(index): item for index, item in enumerate(value)}
+    if isinstance(value, dict):
+        for child, item in value.items():
+            _flatten(_child(key, str(child)), item, rows)
+    elif value is not None:
+        rows.append((key, json.dumps(value)))
+    return rows
+
+
+def _as_arrays(value: object) -> object:
+    # Objects with mostly sequential integer keys are returned as lists, like Firebase does
+    if not isinstance(value, dict):
+        return value
+    value = {key: _as_arrays(item) for key, item in value.items()}
+    if value and all(key.isdigit() and (key == "0" or key[0] != "0") for key in value):
+        size = max(int(key) for key in value) + 1
+        if size < 2 * len(value):
+            return [value.get(str(index)) for index in range(size)]
+    return value
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in a local SQLite database, ":memory:" keeps everything in memory.
+    The tree is stored as one row per leaf, participants are kept in their own table
+    indexed by lottery_id and user_id. Unlike Firebase, keys are ordered as strings, which
+    is the same for the equal width timestamps schedule/ is keyed by.
+    """
+
+    def __init__(self, path: str = ":memory:", **kwargs) -> None:
+        """
+        path: Database file, shared by several processes in WAL mode.
+        kwargs: Storage settings.
+        """
+        super().__init__(**kwargs)
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(_SCHEMA)
+        # sqlite3 connections are not thread safe, every call runs in the same thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args))
+
+    async def _in_transaction(self, func, *args):
+        def run():
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+        return await self._run(run)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self.conn.close()
+
+    def _subtree(self, key: str, columns: str = "path, value") -> sqlite3.Cursor:
+        if not key:
+            return self.conn.execute(f"SELECT {columns} FROM nodes ORDER BY path")
+        return self.conn.execute(
+            f"SELECT {columns} FROM nodes WHERE path = ? OR (path > ? AND path < ?) ORDER BY path",
+            (key, key + SEP, key + END))
+
+    def _get(self, key: str) -> object:
+        result = None
+        for path, value in self._subtree(key):
+            if path == key:
+                return json.loads(value)
+            node = result = result or {}
+            *parents, name = path[len(key) + 1 if key else 0:].split(SEP)
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[name] = json.loads(value)
+        return _as_arrays(result)
+
+    def _drop_participants(self, key: str) -> None:
+        parts = key.split(SEP) if key else []
+        if parts in ([], ["lotteries"]):
+            self.conn.execute("DELETE FROM participants")
+        elif parts[0] == "lotteries" and (len(parts) == 2 or parts[2] == "participants"):
+            self.conn.execute("DELETE FROM participants WHERE lottery_id = ?", (parts[1],))
+
+    def _set(self, key: str, value: object) -> None:
+        if not key:
+            self.conn.execute("DELETE FROM nodes")
+        else:
+            self.conn.execute("DELETE FROM nodes WHERE path = ? OR (path > ? AND path < ?)",
+                              (key, key + SEP, key + END))
+            # A leaf can't have children, so leaves on the way to key are replaced
+            parts = key.split(SEP)
+            self.conn.executemany("DELETE FROM nodes WHERE path = ?",
+                                  [(SEP.join(parts[:i]),) for i in range(1, len(parts))])
+        self._drop_participants(key)
+        self.conn.executemany("INSERT INTO nodes VALUES (?, ?)", _flatten(key, value, []))
+
+    def _set_many(self, key: str, data: dict) -> None:
+        for child, value in data.items():
+            self._set(_child(key, _key(str(child))), value)
+
+    def _transaction_sync(self, key: str, func) -> object:
+        value = func(self._get(key))
+        self._set(key, value)
+        return value
+
+    def _children(self, key: str, start: str | None, end: str | None) -> sqlite3.Cursor:
+        low = _child(key, start) if start is not None else key + SEP if key else ""
+        high = _child(key, end) + END if end is not None else key + END if key else None
+        if high is None:
+            return self.conn.execute("SELECT path, value FROM nodes WHERE path >= ? ORDER BY path", (low,))
+        return self.conn.execute(
+            "SELECT path, value FROM nodes WHERE path >= ? AND path < ? ORDER BY path", (low, high))
+
+    @staticmethod
+    def _group(key: str, rows, limit: int | None = None) -> dict:
+        result = {}
+        prefix = len(key) + 1 if key else 0
+        for path, value in rows:
+            name, *rest = path[prefix:].split(SEP)
+            if name not in result and limit is not None and len(result) == limit:
+                break
+            if not rest:
+                result[name] = json.loads(value)
+                continue
+            node = result.setdefault(name, {})
+            for parent in rest[:-1]:
+                node = node.setdefault(parent, {})
+            node[rest[-1]] = json.loads(value)
+        return {name: _as_arrays(value) for name, value in result.items()}
+
+    def _shallow(self, key: str) -> dict:
+        result = {}
+        prefix = key + SEP if key else ""
+        low = prefix
+        # Skips over every child's subtree, so only one row per child is read
+        while True:
+            row = self.conn.execute(
+                "SELECT path, value FROM nodes WHERE path >= ? AND path < ? ORDER BY path LIMIT 1",
+                (low, key + END if key else "\U0010ffff")).fetchone()
+            if row is None:
+                return result
+            name, *rest = row[0][len(prefix):].split(SEP)
+            result[name] = True if rest else json.loads(row[1])
+            low = prefix + name + END
+
+    async def _read(self, path: str) -> object|str|int|dict|None:
+        return await self._run(self._get, _key(path))
+
+    async def _write(self, path: str, data: object) -> None:
+        await self._in_transaction(self._set, _key(path), data)
+
+    async def _update(self, path: str, data: dict) -> None:
+        await self._in_transaction(self._set_many, _key(path), data)
+
+    async def _delete(self, path: str) -> None:
+        await self._in_transaction(self._set, _key(path), None)
+
+    async def _transaction(self, path: str, func) -> object:
+        return await self._in_transaction(self._transaction_sync, _key(path), func)
+
+    async def _read_shallow(self, path: str) -> dict:
+        return await self._run(self._shallow, _key(path))
+
+    async def _read_range(self, path: str, start: str | None, end: str | None) -> dict:
+        key = _key(path)
+        return await self._run(lambda: self._group(key, self._children(key, start, end)))
+
+    async def _read_page(self, path: str, start_after: str | None, limit: int) -> dict:
+        key = _key(path)
+        start = None if start_after is None else start_after + END
+        return await self._run(lambda: self._group(key, self._children(key, start, None), limit))
+
+    def _add_participant(self, lottery_id: str, user_id: int, username: str) -> int | None:
+        key = _key(f"lotteries/{lottery_id}")
+        if not self.conn.execute("SELECT 1 FROM nodes WHERE path > ? AND path < ? LIMIT 1",
+                                 (key + SEP, key + END)).fetchone():
+            raise LotteryNotFound(lottery_id)
+        cursor = self.conn.execute("INSERT OR IGNORE INTO participants VALUES (?, ?, ?)",
+                                   (lottery_id, user_id, username))
+        if not cursor.rowcount:
+            return None
+        return self._transaction_sync(_key(f"lotteries/{lottery_id}/participant_count"),
+                                      lambda count: (count or 0) + 1)
+
+    async def add_participant(self, lottery_id: str, user_id: int, username: str | None) -> int | None:
+        try:
+            return await self._timed("add_participant", f"lotteries/{lottery_id}",
+                                     self._in_transaction(self._add_participant, lottery_id, user_id, username or ""))
+        except LotteryNotFound:
+            self.lottery_cache.pop(lottery_id)
+            raise
+
+    async def has_participant(self, lottery_id: str, user_id: int) -> bool:
+        row = await self._timed("has_participant", f"lotteries/{lottery_id}", self._run(lambda: self.conn.execute(
+            "SELECT 1 FROM participants WHERE lottery_id = ? AND user_id = ?", (lottery_id, user_id)).fetchone()))
+        return row is not None
+
+    async def iter_participants(self, lottery_id: str, page_size: int = 1000) -> AsyncIterator[tuple[str, str]]:
+        last_id = 0
+        while True:
+            page = await self._timed("read_page", f"lotteries/{lottery_id}", self._run(lambda: self.conn.execute(
+                "SELECT user_id, username FROM participants WHERE lottery_id = ? AND user_id > ? "
+                "ORDER BY user_id LIMIT ?", (lottery_id, last_id, page_size)).fetchall()))
+            for user_id, username in page:
+                yield str(user_id), username
+            if len(page) < page_size:
+                return
+            last_id = page[-1][0]
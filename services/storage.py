@@ -0,0 +1,387 @@
+import asyncio
+import json
+import logging
+import re
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator, Callable
+
+from services.cache import TTLCache
+from services.metrics import SIZE_BUCKETS, metrics
+
+logger = logging.getLogger(__name__)
+
+# Children of lotteries/{id} which change after publishing and are not cached
+_LOTTERY_VOLATILE = {"participants", "participant_count"}
+
+STORAGE_SECONDS = metrics.histogram("storage_call_seconds", "Time spent in storage calls")
+STORAGE_BYTES = metrics.histogram("storage_payload_bytes", "JSON size of values written or read by storage calls",
+                                  SIZE_BUCKETS)
+
+
+class _AlreadyParticipating(Exception):
+    pass
+
+
+class _NoParticipantCount(Exception):
+    pass
+
+
+class LotteryNotFound(Exception):
+    """
+    Raised on joining a lottery which was drawn or deleted.
+    """
+
+
+class Storage(ABC):
+    """
+    Tree of JSON values addressed by "/"-separated paths, the layout of Firebase Realtime DB.
+    Backends implement the underscored primitives, the bot's data model is built on top of
+    them here: lotteries/, schedule/, users/, chats/, leases/ and persistence/.
+    """
+
+    def __init__(self, lottery_cache_size: int = 10_000, lottery_cache_ttl: float = 300,
+                 participant_buckets: int = 16) -> None:
+        """
+        lottery_cache_size: Max number of lotteries kept by get_lottery cache.
+        lottery_cache_ttl: Time in seconds a lottery is kept by get_lottery cache.
+        participant_buckets: Number of buckets participants of new lotteries are split into.
+        """
+        self.participant_buckets = participant_buckets
+        self.lottery_cache = TTLCache(lottery_cache_size, lottery_cache_ttl)
+        metrics.gauge("lottery_cache_lookups", "get_lottery cache lookups since start by result",
+                      lambda: [({"result": "hit"}, self.lottery_cache.hits),
+                               ({"result": "miss"}, self.lottery_cache.misses)])
+        metrics.gauge("lottery_cache_size", "Lotteries kept by get_lottery cache",
+                      lambda: [({}, len(self.lottery_cache))])
+        # Bumped on every invalidation, reads started before it are not cached
+        self._cache_generation = 0
+
+    @abstractmethod
+    async def _read(self, path: str) -> object|str|int|dict|None: ...
+
+    @abstractmethod
+    async def _write(self, path: str, data: object) -> None: ...
+
+    @abstractmethod
+    async def _update(self, path: str, data: dict) -> None:
+        """
+        Atomically writes data[key] to path/key for every key, keys may be paths themselves.
+        """
+
+    @abstractmethod
+    async def _delete(self, path: str) -> None: ...
+
+    @abstractmethod
+    async def _transaction(self, path: str, func: Callable[[object], object]) -> object: ...
+
+    @abstractmethod
+    async def _read_shallow(self, path: str) -> dict: ...
+
+    @abstractmethod
+    async def _read_range(self, path: str, start: str | None, end: str | None) -> dict: ...
+
+    @abstractmethod
+    async def _read_page(self, path: str, start_after: str | None, limit: int) -> dict:
+        """
+        Reads up to limit children of path with keys after start_after ordered by key.
+        """
+
+    def close(self) -> None:
+        pass
+
+    async def _timed(self, op: str, path: str, call, payload: object = None) -> object:
+        """
+        Awaits call recording its time and the size of payload, of the result if payload is None,
+        labelled with op and the top level node of path.
+        """
+        root = path.strip("/").split("/")[0] or "/"
+        with STORAGE_SECONDS.time(op=op, root=root):
+            result = await call
+        value = result if payload is None else payload
+        if value is not None:
+            STORAGE_BYTES.observe(len(json.dumps(value, default=str)), op=op, root=root)
+        return result
+
+    def _invalidate(self, path: str) -> None:
+        """
+        Drops cached lotteries whose metadata may be changed by a write to path.
+        """
+        parts = path.strip("/").split("/")
+        if parts[0] in ("", "lotteries") and len(parts) == 1:
+            self._cache_generation += 1
+            self.lottery_cache.clear()
+        elif parts[0] == "lotteries" and (len(parts) == 2 or parts[2] not in _LOTTERY_VOLATILE):
+            self._cache_generation += 1
+            self.lottery_cache.pop(parts[1])
+
+    def _invalidate_children(self, path: str, keys) -> None:
+        for key in keys:
+            self._invalidate(f"{path.rstrip('/')}/{key}")
+
+
+    async def write(self, path: str, data: int|dict|str|object) -> None:
+        self._invalidate(path)
+        await self._timed("write", path, self._write(path, data), data)
+
+
+    async def update(self, path: str, data: dict) -> None:
+        self._invalidate_children(path, data)
+        await self._timed("update", path, self._update(path, data), data)
+
+
+    async def read(self, path: str) -> object|str|int|dict|None:
+        return await self._timed("read", path, self._read(path))
+
+
+    async def delete(self, path: str) -> None:
+        self._invalidate(path)
+        await self._timed("delete", path, self._delete(path))
+
+
+    async def read_many(self, paths: list[str]) -> list[object|str|int|dict|None]:
+        """
+        Reads several paths concurrently, values are returned in the order of paths.
+        """
+        return list(await asyncio.gather(*(self.read(path) for path in paths)))
+
+
+    async def update_many(self, data: dict[str, object]) -> None:
+        """
+        Atomically writes {path: value} for several paths in one request, None deletes the path.
+        """
+        if data:
+            await self.update("/", data)
+
+
+    async def read_shallow(self, path: str) -> dict:
+        """
+        Reads direct children of path: leaf values as is, nested objects as True.
+        """
+        return await self._timed("read_shallow", path, self._read_shallow(path))
+
+
+    async def read_page(self, path: str, start_after: str | None = None, limit: int = 1000) -> dict:
+        """
+        Reads up to limit children of path with keys after start_after ordered by key.
+        """
+        return await self._timed("read_page", path, self._read_page(path, start_after, limit))
+
+
+    async def read_fields(self, path: str, fields: list[str]) -> dict:
+        """
+        Reads only the given children of path, missing ones are omitted.
+        """
+        values = await self.read_many([f"{path}/{field}" for field in fields])
+        return {field: value for field, value in zip(fields, values) if value is not None}
+
+
+    async def read_range(self, path: str, start: str|int|None = None, end: str|int|None = None) -> dict:
+        """
+        Reads children of path with keys in [start, end] ordered by key.
+        """
+        start, end = None if start is None else str(start), None if end is None else str(end)
+        return await self._timed("read_range", path, self._read_range(path, start, end))
+
+
+    async def transaction(self, path: str, func) -> object|str|int|dict|None:
+        """
+        Atomically replaces the value at path with func(current_value).
+        func may raise to abort, the exception is propagated to the caller.
+        func must not return None: Firebase transactions can't delete.
+        """
+        def checked(current):
+            value = func(current)
+            if value is None:
+                raise ValueError(f"transaction on {path} returned None")
+            return value
+
+        self._invalidate(path)
+        return await self._timed("transaction", path, self._transaction(path, checked))
+
+
+    async def _participant_buckets(self, lottery_id: str) -> int | None:
+        # Lotteries published before sharding keep participants in a flat node
+        return (await self.get_lottery(lottery_id)).get("participant_buckets")
+
+    @staticmethod
+    def _participant_path(lottery_id: str, user_id: int | str, buckets: int | None) -> str:
+        if buckets:
+            return f"lotteries/{lottery_id}/participants/{int(user_id) % buckets}/{user_id}"
+        return f"lotteries/{lottery_id}/participants/{user_id}"
+
+    async def add_participant(self, lottery_id: str, user_id: int, username: str | None) -> int | None:
+        """
+        Adds user to the lottery participants and increments participant_count.
+        Returns the new participant count or None if user already participates.
+        Raises LotteryNotFound if the lottery is gone, e.g. drawn by another worker
+        while this one still had it cached.
+        Participants are stored in participant_buckets hash buckets: participants/{user_id % N}/{user_id}.
+        """
+        def join(current):
+            if current is not None:
+                raise _AlreadyParticipating
+            return username or ""
+
+        try:
+            buckets = await self._participant_buckets(lottery_id)
+            path = self._participant_path(lottery_id, user_id, buckets)
+            await self.transaction(path, join)
+        except _AlreadyParticipating:
+            return None
+        try:
+            return await self._count_participant(lottery_id)
+        except LotteryNotFound:
+            # The join recreated a part of a removed lottery
+            await self.delete(path)
+            self.lottery_cache.pop(lottery_id)
+            raise
+        except Exception:
+            # An uncounted participant is removed, so the user can retry
+            await self.delete(path)
+            raise
+
+    async def _count_participant(self, lottery_id: str) -> int:
+        def increment(count):
+            if count is None:
+                raise _NoParticipantCount
+            return count + 1
+
+        count_path = f"lotteries/{lottery_id}/participant_count"
+        try:
+            return await self.transaction(count_path, increment)
+        except _NoParticipantCount:
+            pass
+        # Lotteries are published with participant_count 0, older ones may have none yet
+        if set(await self.read_shallow(f"lotteries/{lottery_id}")) - _LOTTERY_VOLATILE:
+            return await self.transaction(count_path, lambda count: (count or 0) + 1)
+        raise LotteryNotFound(lottery_id)
+
+    async def has_participant(self, lottery_id: str, user_id: int) -> bool:
+        buckets = await self._participant_buckets(lottery_id)
+        return await self.read(self._participant_path(lottery_id, user_id, buckets)) is not None
+
+    async def get_participant_count(self, lottery_id: str) -> int:
+        return await self.read(f"lotteries/{lottery_id}/participant_count") or 0
+
+    async def get_lottery(self, lottery_id: str) -> dict:
+        """
+        Reads the lottery without its participants subtree, {} if it doesn't exist.
+        Lotteries don't change after publishing, so they are served from lottery_cache
+        until a write through this client touches them.
+        """
+        cached = self.lottery_cache.get(lottery_id)
+        if cached is not None:
+            return dict(cached)
+        path = f"lotteries/{lottery_id}"
+        generation = self._cache_generation
+        lottery, linked_channels = await asyncio.gather(
+            self.read_shallow(path), self.read(f"{path}/linked_channels"))
+        for key in _LOTTERY_VOLATILE | {"linked_channels"}:
+            lottery.pop(key, None)
+        if linked_channels:
+            lottery["linked_channels"] = linked_channels
+        if lottery and generation == self._cache_generation:
+            self.lottery_cache.set(lottery_id, lottery)
+        return dict(lottery)
+
+    async def iter_participants(self, lottery_id: str, page_size: int = 1000) -> AsyncIterator[tuple[str, str]]:
+        """
+        Yields (user_id, username) of the lottery participants reading them bucket by bucket,
+        page by page, so at most one page is held in memory.
+        """
+        buckets = await self._participant_buckets(lottery_id)
+        if not buckets:
+            async for item in self._iter_children(f"lotteries/{lottery_id}/participants", page_size):
+                yield item
+            return
+        for bucket in range(buckets):
+            async for item in self._iter_children(f"lotteries/{lottery_id}/participants/{bucket}", page_size):
+                yield item
+
+    @staticmethod
+    def _key_order(key: str) -> object:
+        """
+        Sort key of child keys in the order of the backend's key queries.
+        """
+        return key
+
+    async def _iter_children(self, path: str, page_size: int) -> AsyncIterator[tuple[str, object]]:
+        last_key = None
+        while True:
+            page = await self.read_page(path, last_key, page_size)
+            progressed = False
+            for key, value in page.items():
+                # Keys only grow, so a child is never yielded twice, e.g. counted twice in a draw
+                if last_key is not None and self._key_order(key) <= self._key_order(last_key):
+                    logger.error(f"children of {path} are paged out of order, {key} after {last_key} is skipped")
+                    continue
+                progressed = True
+                last_key = key
+                yield key, value
+            if len(page) < page_size or not progressed:
+                return
+
+    async def get_user_channels(self, user_id: int) -> list:
+        channels = []
+        for key, channel in _channel_entries(await self.read(f"users/{user_id}/channels")):
+            # Legacy entries have no title, only the mention_html of the chat
+            if not channel.get("title"):
+                match = re.search(r">([^<]+)<", channel.get("username", ""))
+                channel = channel | {"title": match.group(1) if match else "Канал"}
+            channels.append(channel)
+        # Channels used to be stored as a list, entries of both layouts are merged by chat_id
+        return list({channel["chat_id"]: channel for channel in channels}.values())
+
+    async def _legacy_channel_paths(self, user_id: int, chat_id: int) -> list[str]:
+        """
+        Paths of the user's entries of chat_id stored in the old list layout, they have no owners index.
+        """
+        path = f"users/{user_id}/channels"
+        # Chats other than private ones have negative ids, legacy entries are keyed by list index.
+        # Only the keys are read unless the user still has legacy entries
+        legacy = [key for key in await self.read_shallow(path) if not key.startswith("-")]
+        if not legacy:
+            return []
+        channels = await self.read_many([f"{path}/{key}" for key in legacy])
+        return [f"{path}/{key}" for key, channel in zip(legacy, channels)
+                if channel and channel.get("chat_id") == chat_id]
+
+    async def add_user_channel(self, user_id: int, channel: dict) -> list[int]:
+        """
+        Registers channel as users/{user_id}/channels/{chat_id} with chats/{chat_id}/owners index
+        and updates the channel status of its other owners in the same write.
+        Legacy entries of the channel are replaced. Returns ids of all the owners.
+        """
+        chat_id = channel["chat_id"]
+        owners, legacy = await asyncio.gather(self.read_shallow(f"chats/{chat_id}/owners"),
+                                              self._legacy_channel_paths(user_id, chat_id))
+        # The user's own entry is rewritten as a whole, a path and its descendant can't be in one update
+        updates = {f"users/{owner}/channels/{chat_id}/status": channel["status"]
+                   for owner in owners if owner != str(user_id)}
+        updates |= {path: None for path in legacy}
+        updates[f"users/{user_id}/channels/{chat_id}"] = channel
+        updates[f"chats/{chat_id}/owners/{user_id}"] = True
+        await self.update_many(updates)
+        return [int(owner) for owner in owners | {str(user_id): True}]
+
+    async def remove_channel(self, chat_id: int, user_id: int | None = None) -> list[int]:
+        """
+        Removes the channel from all its owners and the legacy entries of user_id,
+        the user who removed the bot. Returns ids of the owners.
+        """
+        owners = await self.read_shallow(f"chats/{chat_id}/owners")
+        legacy = await self._legacy_channel_paths(user_id, chat_id) if user_id is not None else []
+        updates = {f"users/{owner}/channels/{chat_id}": None for owner in owners}
+        updates |= {path: None for path in legacy}
+        updates[f"chats/{chat_id}"] = None
+        await self.update_many(updates)
+        return [int(owner) for owner in owners]
+
+
+def _channel_entries(data) -> list[tuple[str, dict]]:
+    """
+    (key, channel) pairs of users/{user_id}/channels, which is a list in the old layout
+    and a dict, keyed by chat_id or by list index, otherwise.
+    """
+    items = data.items() if isinstance(data, dict) else enumerate(data) if isinstance(data, list) else []
+    return [(str(key), channel) for key, channel in items if channel]
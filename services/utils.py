@@ -1,17 +1,49 @@
 import base64
-import json
-
-def encode_payload(user_id: int, lottery_uuid: str) -> str:
-    payload = {
-        "user_id": user_id,
-        "lottery_id": lottery_uuid
-    }
-    json_str = json.dumps(payload, separators=(',', ':'))  # компактнее
-    encoded = base64.urlsafe_b64encode(json_str.encode()).decode().rstrip("=")
-    return encoded
-
-
-def decode_payload(encoded: str) -> dict:
-    padded = encoded + '=' * ((4 - len(encoded) % 4) % 4)
-    json_str = base64.urlsafe_b64decode(padded).decode()
-    return json.loads(json_str)
\ No newline at end of file
+import binascii
+import hashlib
+import hmac
+import struct
+import time
+
+PAYLOAD_VERSION = 1
+# version, owner user_id, lottery_id (8 hex chars), expiry unix time
+_PAYLOAD = struct.Struct(">BqII")
+_MAC_SIZE = 10
+# 27 bytes are 36 base64 chars without padding, well within 64 chars of a /start parameter
+PAYLOAD_LENGTH = len(base64.urlsafe_b64encode(bytes(_PAYLOAD.size + _MAC_SIZE)))
+
+
+def _mac(secret: bytes, body: bytes) -> bytes:
+    return hmac.digest(secret, body, hashlib.sha256)[:_MAC_SIZE]
+
+
+def payload_secret(secret: str) -> bytes:
+    return hashlib.sha256(b"deep-link:" + secret.encode()).digest()
+
+
+def encode_payload(user_id: int, lottery_uuid: str, expires: int, secret: bytes) -> str:
+    """
+    Packs the lottery link into a /start parameter signed with secret, valid until expires.
+    """
+    body = _PAYLOAD.pack(PAYLOAD_VERSION, user_id, int(lottery_uuid, 16), expires)
+    return base64.urlsafe_b64encode(body + _mac(secret, body)).decode()
+
+
+def decode_payload(encoded: str, secret: bytes, now: float | None = None) -> dict | None:
+    """
+    Unpacks a /start parameter made by encode_payload.
+    Returns None if it's mangled, not signed with secret or expired.
+    """
+    if len(encoded) != PAYLOAD_LENGTH:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(encoded)
+    except (binascii.Error, ValueError):
+        return None
+    body, mac = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+    if not hmac.compare_digest(mac, _mac(secret, body)):
+        return None
+    version, user_id, lottery_id, expires = _PAYLOAD.unpack(body)
+    if version != PAYLOAD_VERSION or expires < (time.time() if now is None else now):
+        return None
+    return {"user_id": user_id, "lottery_id": f"{lottery_id:08x}", "expires": expires}